@@ -0,0 +1,298 @@
+'''asyncio download engine, same contract as download_file / download_file_in_chunks in donwloader.py
+
+All downloads of the process run on one event loop in a background thread and
+share one aiohttp session, so hundreds of ranged requests over many files don't
+need hundreds of OS threads. Needs aiohttp: pip install aiohttp
+'''
+import asyncio
+import atexit
+import os
+import threading
+import time
+import urllib.parse
+import zlib
+
+from donwloader import stop_event, rate_limiter, PART_SUFFIX, STREAM_BLOCK_SIZE, TUNE_INTERVAL, RETRY_STATUS, HOST_STATE_FILE, \
+    ConcurrencyController, RemoteChanged, check_range_response, open_output_fd, write_at, read_recover_file, prepare_scheduler, allocate_file, \
+    verify_download, remove_part_file, print_download_bytes, print_speed
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+loop = None
+loop_lock = threading.Lock()
+client = None
+max_connections = 0  # aiohttp connector limit, 0 no limit
+
+def set_max_connections(n):
+    global max_connections
+    max_connections = max(n, 0)
+
+def get_loop():
+    global loop
+    with loop_lock:
+        if loop is None:
+            if aiohttp is None:
+                raise ImportError("async engine needs aiohttp, pip install aiohttp")
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+@atexit.register
+def close():
+    global client
+    if loop is not None and client is not None:
+        asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout=5)
+        client = None
+
+def run(coro):
+    '''run coroutine on the shared loop, wait in the calling thread
+    '''
+    future = asyncio.run_coroutine_threadsafe(coro, get_loop())
+    try:
+        return future.result()
+    except KeyboardInterrupt:
+        # let the coroutine see the stop event, save its recover file and return
+        stop_event.set()
+        future.result()
+        print("All connections stopped, exit")
+        exit(0)
+
+async def get_client(session):
+    '''one aiohttp session for all downloads, headers and cookies taken from the requests session
+    '''
+    global client
+    if client is None:
+        connector = aiohttp.TCPConnector(limit=max_connections)
+        client = aiohttp.ClientSession(connector=connector, headers=dict(session.headers), cookies=dict(session.cookies),
+                                       timeout=aiohttp.ClientTimeout(sock_connect=10, sock_read=20))  # set timeout, so don't hang long time
+    return client
+
+def in_executor(fn, *args):
+    '''run blocking file io (write, fsync, verify) on a thread, a slow disk doesn't stall the other transfers on the loop
+    '''
+    return asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+def range_headers(start, end):
+    end = '' if end == -1 else end
+    return {'Range': f'bytes={start}-{end}'}
+
+def download_file(session, url, output_file='output.mp4', print_info=False, repeat=1, checksum=None):
+    '''donwload file single connection, written as output_file.part and renamed when complete
+    '''
+    part_file = output_file + PART_SUFFIX
+    succ = False
+    try:
+        succ = run(download_file_async(session, url, part_file, print_info, repeat, checksum))
+        if succ:
+            os.replace(part_file, output_file)
+        return succ
+    finally:
+        if not succ:
+            # failed, stopped or interrupted (run exits), only the chunked path keeps partial data
+            remove_part_file(part_file)
+
+async def download_file_async(session, url, output_file, print_info, repeat, checksum):
+    client = await get_client(session)
+    while True:
+        repeat -= 1
+        try:
+            tic = time.time()
+            crc = 0
+            async with client.get(url, headers=range_headers(0, -1)) as response:
+                if response.status in RETRY_STATUS and repeat > 0:
+                    retry_after = response.headers.get('Retry-After', '')
+                    wait = int(retry_after) if retry_after.isdigit() else 2
+                    print(f"HTTP response code {response.status}, retry after {wait}s, repeat {repeat}")
+                    await asyncio.sleep(min(wait, 60))
+                    continue
+                if response.status not in [200, 206]:
+                    # don't save an error page as the video
+                    print(f"Error: HTTP response code {response.status}, {url}")
+                    return False
+                expected_size = response.content_length if 'Content-Encoding' not in response.headers else None
+                etag = response.headers.get('ETag', '')
+                with open(output_file, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(rate_limiter.block_size(1024**2)):
+                        if stop_event.is_set():
+                            return False
+                        await asyncio.sleep(rate_limiter.reserve(len(chunk)))
+                        await in_executor(f.write, chunk)
+                        crc = zlib.crc32(chunk, crc)
+                        downloaded_bytes = f.tell()
+                        if print_info:
+                            print(f"Downloaded {downloaded_bytes:,} bytes avg: {downloaded_bytes/(time.time()-tic)/1024**2:4.2f} MiB/s", end='\r')
+                    total_size = f.tell()
+            if expected_size is not None and total_size != expected_size:
+                raise Exception(f"incomplete file, got {total_size:,}/{expected_size:,} bytes")
+            if print_info:
+                print_speed(time.time() - tic, total_size)
+            if checksum is not None:
+                checksum.update({'crc32': f"{crc:08x}", 'size': total_size, 'etag': etag})
+            return True
+        except Exception as e:
+            print(f"Exception {e}, repeat {repeat}")
+            if repeat <= 0:
+                return False
+
+def download_file_in_chunks(session, url, start_offset=64, chunk_size=100 * 1024 * 1024, output_file='output.mp4', recover_file="", max_threads=4, repeat=1, journal_interval=5,
+                            auto_threads=False, max_auto_threads=16, state_file=HOST_STATE_FILE, preallocate=True, check_space=False, checksum=None):
+    '''donwload file with max_threads concurrent ranged requests on the shared loop
+    '''
+    return run(download_file_in_chunks_async(session, url, start_offset, chunk_size, output_file, recover_file, max_threads, repeat, journal_interval,
+                                             auto_threads, max_auto_threads, state_file, preallocate, check_space, checksum))
+
+async def download_range(client, url, fd, tid, scheduler, task, repeat, controller):
+    '''download one range of the scheduler, return (success, bytes)
+    '''
+    range_id, start, end = task
+    print(f"{f'Task {tid}: Downloading range':<30s} {range_id:3d} {start:,}-{end:,}")
+    tic = time.time()
+    pos = start
+    crc = 0
+    repeat_t = repeat
+    while not stop_event.is_set():
+        repeat_t -= 1
+        try:
+            # retry continues from the last written byte, not the range start
+            end = scheduler.end_of(range_id)
+            async with client.get(url, headers=range_headers(pos, end)) as response:
+                if response.status in RETRY_STATUS and repeat_t > 0:
+                    if controller:
+                        controller.report_error()
+                    retry_after = response.headers.get('Retry-After', '')
+                    wait = int(retry_after) if retry_after.isdigit() else 2
+                    print(f'Task {tid} HTTP response code {response.status}, downloading {range_id}, retry after {wait}s, repeat {repeat_t}')
+                    await asyncio.sleep(min(wait, 60))
+                    continue
+                if response.status != 206:
+                    print(f'Task {tid} Error: HTTP response code {response.status}, downloading {range_id} {pos:,}-{end:,}')
+                    scheduler.fail(range_id)
+                    return False, pos - start
+                check_range_response(response.headers, pos, end, scheduler.total_size, scheduler.etag)
+                async for data in response.content.iter_chunked(rate_limiter.block_size(STREAM_BLOCK_SIZE)):
+                    if stop_event.is_set():
+                        break
+                    await asyncio.sleep(rate_limiter.reserve(len(data)))
+                    end = scheduler.end_of(range_id)
+                    data = data[:end - pos + 1]  # tail may have been stolen
+                    await in_executor(write_at, fd, data, pos)
+                    crc = zlib.crc32(data, crc)
+                    pos += len(data)
+                    end = scheduler.update(range_id, pos, crc)
+                    if pos > end:
+                        break
+            if stop_event.is_set():
+                break
+            end = scheduler.end_of(range_id)
+            if pos <= end:
+                raise Exception(f"incomplete range, got {pos - start:,}/{end - start + 1:,} bytes")
+            scheduler.finish(range_id, tid, pos - start, time.time() - tic)
+            print(f'{"         Downloaded range":<30s} {range_id:3d}')
+            return True, pos - start
+        except RemoteChanged as e:
+            print(f'Task {tid} Error: {e}, downloading {range_id}')
+            scheduler.fail(range_id)
+            return False, pos - start
+        except Exception as e:
+            print(f'Task {tid} Exception {e!r}, downloading {range_id}, repeat {repeat_t}')
+            if controller:
+                controller.report_error()
+            if repeat_t <= 0:
+                scheduler.fail(range_id)
+                return False, pos - start
+    return False, pos - start
+
+async def download_file_in_chunks_async(session, url, start_offset, chunk_size, output_file, recover_file, max_threads, repeat, journal_interval,
+                                        auto_threads, max_auto_threads, state_file, preallocate, check_space, checksum):
+    client = await get_client(session)
+    tic = time.time()
+    recover_data = read_recover_file(recover_file)
+    fd = open_output_fd(output_file, truncate=recover_data is None)
+    # get total size
+    repeat_t = repeat
+    while True:
+        repeat_t -= 1
+        try:
+            async with client.get(url, headers=range_headers(0, start_offset-1)) as response:
+                head = await response.read()
+                content_range = response.headers.get('Content-Range')
+                etag = response.headers.get('ETag', '')
+            break
+        except Exception as e:
+            if repeat_t <= 0:
+                print("Get total size failed")
+                print(f"Exception {e}, repeat {repeat}")
+                os.close(fd)
+                return False
+    total_size = int(content_range.split('/')[-1])
+    scheduler = prepare_scheduler(fd, recover_file, recover_data, total_size, start_offset, chunk_size, etag)
+    if not allocate_file(fd, output_file, total_size, preallocate, check_space):
+        os.close(fd)
+        return False
+    scheduler.write_head(head)
+
+    controller = None
+    if auto_threads:
+        host = urllib.parse.urlsplit(url).hostname
+        controller = ConcurrencyController(host, max_threads, max_auto_threads, state_file)
+        max_threads = controller.max_limit
+
+    result = {'success': True, 'bytes': 0}
+    async def worker(tid):
+        scheduler.range_size.setdefault(tid, scheduler.chunk_size)
+        while not stop_event.is_set():
+            if controller and not controller.allowed(tid):
+                # parked by the controller, wait until allowed again or work is done
+                if not scheduler.has_work():
+                    break
+                await asyncio.sleep(0.5)
+                continue
+            task = scheduler.next_range(tid)
+            if task is None:
+                break
+            succ, nbytes = await download_range(client, url, fd, tid, scheduler, task, repeat, controller)
+            result['bytes'] += nbytes
+            if not succ:
+                result['success'] = False
+
+    async def housekeeping():
+        last_save = last_tune = time.time()
+        while True:
+            await asyncio.sleep(1)
+            if time.time() - last_save >= journal_interval:
+                save = in_executor(scheduler.save)
+                try:
+                    await asyncio.shield(save)
+                except asyncio.CancelledError:
+                    await save  # cancelled during the save, let it finish before the final save/remove
+                    raise
+                last_save = time.time()
+            if controller and time.time() - last_tune >= TUNE_INTERVAL:
+                controller.sample(scheduler.written)
+                last_tune = time.time()
+
+    keeper = asyncio.create_task(housekeeping())
+    await asyncio.gather(*[worker(tid) for tid in range(max_threads)])
+    keeper.cancel()
+    try:
+        await keeper
+    except asyncio.CancelledError:
+        pass
+
+    success = result['success'] and not stop_event.is_set()
+    if success and not await in_executor(verify_download, scheduler, checksum):
+        success = False
+    if not success:
+        await in_executor(scheduler.save)
+        print(f"Remain {scheduler.remain_bytes():,} bytes")
+    else:
+        await in_executor(scheduler.remove)
+    os.close(fd)
+    if controller:
+        controller.save_state()
+
+    print_download_bytes(tic, result['bytes'])
+    return success
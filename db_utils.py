@@ -1,27 +1,29 @@
+import bisect
 import glob
 import json
 import os
 import re
 import shutil
 import subprocess
+import time
 import ffmpeg
 import urllib.parse
 from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from donwloader import seconds_to_hms
+from library import open_library, make_short_video_json
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
 
 '''API functions
 '''
 # db
 def read_db_json(root_dir):
-    # read playlist json
-    db_json_path = os.path.join(root_dir, 'top.json')
-    db_json = {'scenes': [], 'current_id': 1000}
-    if os.path.exists(db_json_path):
-        with open(db_json_path, 'r') as f:
-            db_json_tmp = json.load(f)
-        if db_json_tmp:  # bad top json file, reset
-            db_json = db_json_tmp
-    return db_json
+    # playlist json, from the library index
+    return open_library(root_dir).to_db_json()
     
 def get_current_id(db_json):
     return db_json['current_id']
@@ -30,9 +32,11 @@ def current_id_inc(db_json):
     db_json['current_id'] += 1
 
 def write_db_json(root_dir, db_json):
-    db_json_path = os.path.join(root_dir, 'top.json')
-    with open(db_json_path, 'w') as f:
-        json.dump(db_json, f, indent=4, ensure_ascii=False)
+    # replace the whole index, prefer the Library methods which only change one title
+    library = open_library(root_dir)
+    with library.batch():
+        library.replace(db_json)
+        library.mark_dirty()
 
 def get_scene_index(db_json):
     scene_index = {}
@@ -67,51 +71,37 @@ def get_video_formats(video_json):
     return formats
 
 def delete_title(root_dir, playlist, title):
-    db_json = read_db_json(root_dir)
-    succ = db_del_title(db_json, playlist, title)
-    if succ:
-        delete_title_files(root_dir, playlist, title)
-        write_db_json(root_dir, db_json)
-        return {"status": True, "msg": "success"}
-    else:
+    library = open_library(root_dir)
+    if not library.has_title(playlist, title):
         return {"status": False, "msg": "Not exist"}
+    library.apply(plan_delete_title(root_dir, playlist, title))
+    return {"status": True, "msg": "success"}
     
 def move_title_from_to(root_dir, src_playlist, dst_playlist, title):
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    if src_playlist not in scene_index or dst_playlist not in scene_index:
+    library = open_library(root_dir)
+    res = check_move_title(library, src_playlist, dst_playlist, title)
+    if not res['status']:
+        return res
+    library.apply(plan_move_title(root_dir, src_playlist, dst_playlist, title))
+    return {"status": True, "msg": "success"}
+
+def check_move_title(library, src_playlist, dst_playlist, title):
+    if not library.has_playlist(src_playlist) or not library.has_playlist(dst_playlist):
         print(f"Playlist {src_playlist} or {dst_playlist} not found")
         return {"status": False, "msg": f"Playlist {src_playlist} or {dst_playlist} not found"}
     
-    title_index = get_title_index(scene_index[src_playlist])
-    if title not in title_index:
+    if not library.has_title(src_playlist, title):
         print(f"Title {title} not found in {src_playlist}")
         return {"status": False, "msg": f"Title {title} not found in {src_playlist}"}
     
-    title_index_dst = get_title_index(scene_index[dst_playlist])
-    if title in title_index_dst:
+    if library.has_title(dst_playlist, title):
         print(f"Title {title} already exists in {dst_playlist}")
         return {"status": False, "msg": f"Title {title} already exists in {dst_playlist}"}
-
-    # update json
-    json_path = os.path.join(root_dir, src_playlist, "metadata", "json", f"{title}.json")
-    json_text_new = replace_file_playlist(json_path, src_playlist, dst_playlist)
-    video_json = json.loads(json_text_new)
-    
-    # move files
-    move_title_files(root_dir, src_playlist, dst_playlist, title)
-    
-    # update db
-    db_json = read_db_json(root_dir)
-    db_del_title(db_json, src_playlist, title)
-    db_add_title(db_json, dst_playlist, video_json)
-    write_db_json(root_dir, db_json)
     return {"status": True, "msg": "success"}
 
 def rename_playlist(root_dir, src_playlist, dst_playlist):
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    if dst_playlist in scene_index:
+    library = open_library(root_dir)
+    if library.has_playlist(dst_playlist):
         print(f"Playlist {dst_playlist} already exists")
         return {"status": False, "msg": f"Playlist {dst_playlist} already exists"}
     
@@ -126,33 +116,50 @@ def rename_playlist(root_dir, src_playlist, dst_playlist):
             replace_file_playlist(json_path, src_playlist, dst_playlist)
     
     # update db
-    scene_index[src_playlist]['name'] = dst_playlist
-    write_db_json(root_dir, db_json)
+    library.rename_playlist(src_playlist, dst_playlist)
     return {"status": True, "msg": "success"}
 
 def change_server(root_dir, old_server, new_server):
+    library = open_library(root_dir)
     playlist_info = {}
-    for playlist in os.listdir(root_dir):
-        playlist_path = os.path.join(root_dir, playlist)
-        if not os.path.isdir(playlist_path):
-            continue
-        if 'metadata' in os.listdir(playlist_path):
-            playlist_info[playlist] = 0  # cnt of files
-            print(f"Processing {playlist}")
-            
-            json_dir = os.path.join(root_dir, playlist, 'metadata/json')
-            
-            for title_json in os.listdir(json_dir):
-                replace_file_server(os.path.join(json_dir, title_json), old_server, new_server)
-                playlist_info[playlist] += 1
-    replace_file_server(os.path.join(root_dir, 'top.json'), old_server, new_server)
+    with library.batch():
+        for playlist in os.listdir(root_dir):
+            playlist_path = os.path.join(root_dir, playlist)
+            if not os.path.isdir(playlist_path):
+                continue
+            if 'metadata' in os.listdir(playlist_path):
+                playlist_info[playlist] = 0  # cnt of files
+                print(f"Processing {playlist}")
+
+                json_dir = os.path.join(root_dir, playlist, 'metadata/json')
+
+                for title_json in os.listdir(json_dir):
+                    replace_file_server(os.path.join(json_dir, title_json), old_server, new_server)
+                    playlist_info[playlist] += 1
+        # top.json and the split deeplink are written from the index when the batch ends
+        library.change_server(old_server, new_server)
     return {"status": True, "msg": playlist_info}
 
 def check_playlist(root_dir, playlist):
+    open_library(root_dir).apply(plan_check_playlist(root_dir, playlist))
+    return {"status": True, "msg": "success"}
+
+def plan_check_playlist(root_dir, playlist, listings=None, titles=None):
+    '''batch ops that drop encodings whose video file is gone, and titles left empty
+
+    titles: only check these titles
+    '''
+    ops = []
     playlist_dir = os.path.join(root_dir, playlist)
     json_dir = os.path.join(root_dir, playlist, "metadata", "json")
-    for file in os.listdir(json_dir):
+    if listings is None:
+        listings = {}
+    existing_files = set(os.listdir(playlist_dir))  # one listdir instead of a stat per video
+    json_files = os.listdir(json_dir) if titles is None else [f"{title}.json" for title in titles]
+    for file in json_files:
         json_file = os.path.join(json_dir, file)
+        if titles is not None and not os.path.exists(json_file):
+            continue
         with open(json_file, 'r') as f:
             video_json = json.load(f)
         title = video_json['title']
@@ -168,8 +175,11 @@ def check_playlist(root_dir, playlist):
             resolution_index = {}
             for src in encoding['videoSources']:
                 resolution_index[src['resolution']] = src
-                video_path = os.path.join(playlist_dir, f"{title} - {encoding['name']} {src['resolution']}p{video_json['ext']}")
-                if not os.path.exists(video_path):
+                if encoding['name'] == HLS_ENCODING:
+                    exists = os.path.exists(os.path.join(playlist_dir, src['path']))
+                else:
+                    exists = f"{title} - {encoding['name']} {src['resolution']}p{video_json['ext']}" in existing_files
+                if not exists:
                     delete_flag = True
                     print(f"{encoding['name']} {src['resolution']}p, not exist")
                     resolution_del.append(src['resolution'])
@@ -189,19 +199,166 @@ def check_playlist(root_dir, playlist):
         if not video_json['encodings']:
             # delete title
             print(f"Delete empty {title}")
-            delete_title(root_dir, playlist, title)
+            ops += plan_delete_title(root_dir, playlist, title, listings)
+        elif delete_flag:
+            ops.append({'op': 'write', 'path': json_file, 'text': json.dumps(video_json, indent=4, ensure_ascii=False)})
+        
+    return ops
+
+TIMELINE_MODES = ['seek', 'keyframe', 'exact']
+TIMELINE_SEEK_JOBS = 4  # ffmpeg processes seeking in parallel per video
+TIMELINE_QUALITY = 70   # jpeg quality of the timeline collage
+RAW_FRAME_ARGS = ['-f', 'rawvideo', '-pix_fmt', 'rgb24', 'pipe:1']  # frames to stdout, no image files
+
+VIDEO_FILE_RE = re.compile(r'(?P<title>.*?)\ -\ (?P<encoding>\w+)\ (?P<quality>\w+)\.(?P<ext>\w+)')  # "title - h265 2160p.mp4"
+
+VIDEO_EXTS = ['.mp4', '.mkv']
+
+def list_video_files(playlist_dir):
+    '''{file name: [size, mtime_ns]} of the videos in playlist_dir
+    '''
+    entries = {}
+    with os.scandir(playlist_dir) as it:
+        for entry in it:
+            if os.path.splitext(entry.name)[1] in VIDEO_EXTS and entry.is_file():
+                st = entry.stat()
+                entries[entry.name] = [st.st_size, st.st_mtime_ns]
+    return entries
+
+def scan_playlist(root_dir, server, playlist, title=None, screenType='flat', stereoMode='sbs', thumbnail_start_time=-1, force_thumbnail=0, jobs=1, timeline_mode='seek', timeline_quality=TIMELINE_QUALITY,
+                  incremental=False, settle=0):
+    '''jobs: videos probed and thumbnailed at the same time (processes)
+    timeline_mode, timeline_quality: see make_thumbnail
+    incremental: only scan video files added or changed since the last scan, drop the removed ones
+    settle: seconds a file must be unchanged before it is scanned (still being written), incremental only
+    '''
+    # top.json is written once at the end, not per title
+    library = open_library(root_dir)
+    playlist_dir = os.path.join(root_dir, playlist)
+    with library.batch():
+        video_files = None
+        if incremental and not title:
+            current = list_video_files(playlist_dir)
+            snapshot = library.get_snapshot(playlist)
+            changed = [name for name, stat in current.items() if snapshot.get(name) != stat]
+            young = time.time_ns() - settle * 10**9
+            video_files = [name for name in changed if current[name][1] <= young]
+            removed = [name for name in snapshot if name not in current]
+            if removed:
+                print(f"{playlist}: {len(removed)} video files removed")
+                titles = set(m.group('title') for m in map(VIDEO_FILE_RE.search, removed) if m)
+                library.apply(plan_check_playlist(root_dir, playlist, titles=titles))
+            if not video_files:
+                if removed:
+                    library.set_snapshot(playlist, {name: stat for name, stat in snapshot.items() if name in current})
+                return {"status": True, "msg": "no change", "deferred": len(changed)}
+            print(f"{playlist}: {len(video_files)} video files added or changed")
+            deferred = len(changed) - len(video_files)
+        
+        if jobs > 1:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                scanned = scan_playlist_helper(library, executor, root_dir, server, playlist, title, video_files, screenType, stereoMode, thumbnail_start_time, force_thumbnail, timeline_mode, timeline_quality)
         else:
-            with open(json_file, 'w') as f:
-                json.dump(video_json, f, indent=4, ensure_ascii=False)
+            scanned = scan_playlist_helper(library, None, root_dir, server, playlist, title, video_files, screenType, stereoMode, thumbnail_start_time, force_thumbnail, timeline_mode, timeline_quality)
         
+        if not title:
+            # snapshot: files scanned now (after rename), the rest as they were at the last scan
+            entries = {} if video_files is None else {name: stat for name, stat in library.get_snapshot(playlist).items() if name in current and name not in video_files}
+            for name in scanned:
+                st = os.stat(os.path.join(playlist_dir, name))
+                entries[name] = [st.st_size, st.st_mtime_ns]
+            library.set_snapshot(playlist, entries)
+    if video_files is not None:
+        return {"status": True, "msg": "success", "deferred": deferred}
     return {"status": True, "msg": "success"}
 
-def scan_playlist(root_dir, server, playlist, title=None, screenType='flat', stereoMode='sbs', thumbnail_start_time=-1, force_thumbnail=0):
-    playlist_dir = os.path.join(root_dir, playlist)
+def watch_playlists(root_dir, server, playlists, interval=10, settle=10, **scan_args):
+    '''long-running incremental scan of playlists, woken by inotify if inotify_simple is installed, else polled every interval seconds
+
+    settle: seconds a video file must be unchanged before it is scanned, files still being written wait for the next round
+    scan_args: passed to scan_playlist
+    '''
+    notify = None
+    if inotify_simple is not None:
+        notify = inotify_simple.INotify()
+        mask = inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO | inotify_simple.flags.MOVED_FROM | inotify_simple.flags.DELETE
+        playlist_of = {notify.add_watch(os.path.join(root_dir, playlist), mask): playlist for playlist in playlists}
+        print(f"Watching {len(playlists)} playlists")
+    else:
+        print(f"inotify_simple not installed, poll every {interval}s")
     
-    # re read current id
-    db_json = read_db_json(root_dir)
-    current_video_id = get_current_id(db_json)
+    dirty = set(playlists)  # first round scans all
+    while True:
+        deferred = False
+        failed = set()
+        for playlist in sorted(dirty):
+            try:
+                res = scan_playlist(root_dir, server, playlist, incremental=True, settle=settle, **scan_args)
+            except Exception as e:
+                # keep watching, the snapshot isn't updated so the playlist is scanned again next round
+                print(f"{playlist}: scan failed: {e}")
+                failed.add(playlist)
+                continue
+            deferred = deferred or res.get('deferred', 0) > 0
+        if notify is None:
+            time.sleep(interval)
+            dirty = set(playlists)
+            continue
+        # block until a video file changes, then wait until the dirs are quiet for settle seconds
+        dirty = set(playlists) if deferred else failed
+        timeout = settle * 1000 if deferred else None
+        while True:
+            events = notify.read(timeout=timeout)
+            if not events:
+                break
+            for event in events:
+                if event.wd in playlist_of and os.path.splitext(event.name)[1] in VIDEO_EXTS:
+                    dirty.add(playlist_of[event.wd])
+            if dirty:
+                timeout = settle * 1000
+
+class InlineResult:
+    '''result of a job run in place, same interface as a Future
+    '''
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+    
+    def result(self):
+        return self.fn(*self.args)
+
+def submit(executor, fn, *args):
+    if executor is None:
+        return InlineResult(fn, *args)  # run when the result is needed, keeps the sequential order of prints
+    return executor.submit(fn, *args)
+
+def submit_probe(executor, library, video_path):
+    '''ffmpeg_probe, skipped when the probe cache has the file
+    '''
+    meta_data = library.get_probe(video_path)
+    if meta_data is not None:
+        return InlineResult(dict, meta_data)
+    return submit(executor, ffmpeg_probe, video_path)
+
+def scan_video_job(root_dir, server, video_path, meta_data, thumbnail_dir, preview_dir, seeklookup_dir, title, thumbnail, screenType, stereoMode, thumbnail_start_time, force_thumbnail, timeline_mode, timeline_quality):
+    '''probe a video (if meta_data is None) and make its thumbnails, runs in a worker process
+    '''
+    if meta_data is None:
+        meta_data = ffmpeg_probe(video_path)
+    thumbnails = None
+    if thumbnail:
+        thumbnails = make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, seeklookup_dir, title, meta_data, screenType=screenType, stereoMode=stereoMode, thumbnail_start_time=thumbnail_start_time, force_thumbnail=force_thumbnail,
+                                    timeline_mode=timeline_mode, timeline_quality=timeline_quality)
+    return meta_data, thumbnails
+
+def scan_playlist_helper(library, executor, root_dir, server, playlist, title, video_files, screenType, stereoMode, thumbnail_start_time, force_thumbnail, timeline_mode, timeline_quality):
+    '''ffmpeg work runs on the executor, ids, json files and the index are only changed here, in file order
+
+    video_files: names to scan, None for all. Return the names scanned, after renaming.
+    A file ffmpeg fails on (unreadable, still being copied) is logged and left out, so it is scanned again next time
+    '''
+    playlist_dir = os.path.join(root_dir, playlist)
+    current_video_id = library.get_current_id()
     
     # prepare dir
     thumbnail_dir = os.path.join(playlist_dir, 'metadata', 'thumbnail')
@@ -211,57 +368,81 @@ def scan_playlist(root_dir, server, playlist, title=None, screenType='flat', ste
     make_dirs(thumbnail_dir, preview_dir, seeklookup_dir, json_dir, exist_ok=True)
     
     # scan playlist_dir
-    if title:
-        video_files = glob.glob(os.path.join(playlist_dir, glob.escape(title)+"*"))
+    if video_files is not None:
+        video_files = list(video_files)
+    elif title:
+        video_files = [os.path.basename(f) for f in glob.glob(os.path.join(playlist_dir, glob.escape(title)+"*"))]
     else:
         video_files = list(os.listdir(playlist_dir))
+    video_files = [f for f in video_files if os.path.splitext(f)[1] in VIDEO_EXTS]  # skip not video files
+    
+    # filename without encoding and quality, probe (in parallel) and rename
+    unnamed = [f for f in video_files if not VIDEO_FILE_RE.search(f)]
+    futures = [submit_probe(executor, library, os.path.join(playlist_dir, f)) for f in unnamed]
+    for video_file, future in zip(unnamed, futures):
+        try:
+            meta_data = future.result()
+        except Exception as e:
+            print(f"Probe {video_file} failed, skip: {e}")
+            video_files.remove(video_file)
+            continue
+        library.set_probe(os.path.join(playlist_dir, video_file), meta_data)  # rename keeps the file identity
+        video_name, ext = os.path.splitext(video_file)
+        video_file_fixed = f"{video_name} - {meta_data['encoding']} {meta_data['resolution']}p{ext}"
+        os.rename(os.path.join(playlist_dir, video_file), os.path.join(playlist_dir, video_file_fixed))
+        video_files[video_files.index(video_file)] = video_file_fixed
     
+    # plan: which files need probe, which titles need thumbnails
+    pending = []
+    thumbnail_titles = set()
     for i, video_file in enumerate(video_files):
-        # skip not video files
-        video_name, ext = os.path.splitext(video_file)
-        if ext not in ['.mp4', '.mkv']:
-            continue
-        
         # get title
         # wheather filename contains encoding and quality
+        m = VIDEO_FILE_RE.search(video_file)
+        title = m.group('title')  # different encoding is seen as same title
+        req_encoding = m.group('encoding')
+        req_resolution = int(m.group('quality')[:-1]) # 1080p -> 1080
+        
+        json_file = os.path.join(root_dir, playlist, 'metadata/json', f"{title}.json")
+        new_title = not os.path.exists(json_file)
+        # thumbnails once per title: for a new title, or when forced
+        thumbnail = (new_title or force_thumbnail) and title not in thumbnail_titles
+        if not new_title and not thumbnail and title not in thumbnail_titles:
+            with open(json_file, 'r') as f:
+                if check_encoding(json.load(f)['encodings'], req_encoding, req_resolution) == 0:
+                    print(f"Processing {i+1:3d}/{len(video_files):<3d}\t {title}")
+                    print(f"Encoding and res Already exists, skip")
+                    continue
+        if thumbnail:
+            thumbnail_titles.add(title)
         video_path = os.path.join(playlist_dir, video_file)
-        is_probed = False
-        m = re.search(r'(?P<title>.*?)\ -\ (?P<encoding>\w+)\ (?P<quality>\w+)\.(?P<ext>\w+)', video_file)
-        if m:
-            title = m.group('title')  # different encoding is seen as same title
-            req_encoding = m.group('encoding')
-            quality = m.group('quality')
-            req_resolution = int(quality[:-1]) # 1080p -> 1080
+        meta_data = library.get_probe(video_path)
+        if meta_data is not None and not thumbnail:
+            future = InlineResult(tuple, (meta_data, None))
         else:
-            title = video_name
-            is_probed = True
-            meta_data = ffmpeg_probe(video_path)
-            video_path_fixed = os.path.join(playlist_dir, f"{title} - {meta_data['encoding']} {meta_data['resolution']}p{ext}")
-            os.rename(video_path, video_path_fixed)
-            video_path = video_path_fixed
-            
-            req_encoding = meta_data['encoding']
-            req_resolution = meta_data['resolution']
-        
+            future = submit(executor, scan_video_job, root_dir, server, video_path, meta_data, thumbnail_dir, preview_dir, seeklookup_dir, title, thumbnail,
+                            screenType, stereoMode, thumbnail_start_time, force_thumbnail, timeline_mode, timeline_quality)
+        pending.append((i, title, video_path, req_encoding, req_resolution, future))
+    
+    # commit results in file order
+    failed = []
+    for i, title, video_path, req_encoding, req_resolution, future in pending:
         print(f"Processing {i+1:3d}/{len(video_files):<3d}\t {title}")
-        
-        def probe_and_create():
-            nonlocal meta_data
-            if not is_probed:
-                meta_data = ffmpeg_probe(video_path)
-            
-            video_json = create_video_json(root_dir, server, playlist, title, video_path, meta_data, screenType=screenType, stereoMode=stereoMode, current_video_id=current_video_id)
-            
-            return meta_data, video_json
+        try:
+            meta_data, thumbnails = future.result()
+        except Exception as e:
+            print(f"Scan {os.path.basename(video_path)} failed, skip: {e}")
+            failed.append(os.path.basename(video_path))
+            continue
+        library.set_probe(video_path, meta_data)
         
         json_file = os.path.join(root_dir, playlist, 'metadata/json', f"{title}.json")
         if not os.path.exists(json_file):
             print(f"Create New video json: {title}")
-            
-            meta_data, video_json = probe_and_create()
+            video_json = create_video_json(root_dir, server, playlist, title, video_path, meta_data, screenType=screenType, stereoMode=stereoMode, current_video_id=current_video_id)
         
-            # make thumbnail etc.
-            thumbnailUrl, videoPreview, videoThumbnail, timelinePreview = make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, seeklookup_dir, title, meta_data, screenType=screenType, stereoMode=stereoMode, thumbnail_start_time=thumbnail_start_time, force_thumbnail=force_thumbnail)
+            # thumbnail etc.
+            thumbnailUrl, videoPreview, videoThumbnail, timelinePreview = thumbnails
             video_json.update({
                 "videoThumbnail": videoThumbnail,
                 "thumbnailUrl": thumbnailUrl,
@@ -271,20 +452,17 @@ def scan_playlist(root_dir, server, playlist, title=None, screenType='flat', ste
             # create video json file
             write_video_json(root_dir, playlist, title, video_json)
             # update db json
-            db_json = read_db_json(root_dir)
-            db_add_title(db_json, playlist, video_json)
+            library.add_title(playlist, video_json)
             current_video_id += 1
-            current_id_inc(db_json)
-            write_db_json(root_dir, db_json)
+            library.current_id_inc()
         else:
             # read existing json
             with open(json_file, 'r') as f:
                 video_json_ori = json.load(f)
 
             # update thumbnail
-            if force_thumbnail:
-                meta_data = ffmpeg_probe(video_path)
-                thumbnailUrl, videoPreview, videoThumbnail, timelinePreview = make_thumbnail(root_dir, video_path, thumbnail_dir, preview_dir, seeklookup_dir, title, meta_data, screenType=screenType, stereoMode=stereoMode, thumbnail_start_time=thumbnail_start_time, force_thumbnail=force_thumbnail)
+            if thumbnails:
+                thumbnailUrl, videoPreview, videoThumbnail, timelinePreview = thumbnails
                 video_json_ori.update({
                     "videoThumbnail": videoThumbnail,
                     "thumbnailUrl": thumbnailUrl,
@@ -299,22 +477,22 @@ def scan_playlist(root_dir, server, playlist, title=None, screenType='flat', ste
                 continue
             
             # new format
-            meta_data, video_json = probe_and_create()
+            video_json = create_video_json(root_dir, server, playlist, title, video_path, meta_data, screenType=screenType, stereoMode=stereoMode, current_video_id=current_video_id)
             add_encoding(video_json_ori['encodings'], video_json['encodings'][0]['name'], video_json['encodings'][0]['videoSources'][0])
             
             # only update video json, db json don't change
             write_video_json(root_dir, playlist, title, video_json_ori)
         
-    return {"status": True, "msg": "success"}
+    return [f for f in video_files if f not in failed]
 
 '''helper functions
 '''
 
 def db_del_playlist(db_json, playlist):
-    scene_index = get_scene_index(db_json)
-    if playlist in scene_index:
-        db_json['scenes'].remove(scene_index[playlist])
-        return True
+    for i, scene in enumerate(db_json['scenes']):
+        if scene['name'] == playlist:
+            del db_json['scenes'][i]  # by position, list.remove compares every dict
+            return True
     return False
 
 def db_add_playlist(db_json, playlist):
@@ -325,20 +503,16 @@ def db_add_playlist(db_json, playlist):
 
 def db_del_title(db_json, playlist, title):
     scene_index = get_scene_index(db_json)
-    title_index = get_title_index(scene_index[playlist])
-    if title in title_index:
-        scene_index[playlist]['list'].remove(title_index[title])
-        return True
+    title_list = scene_index[playlist]['list']
+    for i, video_json in enumerate(title_list):
+        if video_json['title'] == title:
+            del title_list[i]  # by position, list.remove compares every dict
+            return True
     return False
 
 def db_add_title(db_json, playlist, video_json):
     title = video_json['title']
-    short_video_json = {
-        'title': video_json['title'],
-        'vidoeLength': video_json['videoLength'],
-        'video_url': video_json['video_url'],
-        'thumbnail_url': video_json['thumbnailUrl'],
-    }
+    short_video_json = make_short_video_json(video_json)
     
     # new scene
     scene_index = get_scene_index(db_json)
@@ -395,13 +569,16 @@ def add_encoding(encodings, encoding, videoSource):
     for s in encoding_index[encoding]['videoSources']:
         if s['resolution'] == videoSource['resolution']:
             return 0 # already exists
-    e['videoSources'].append(videoSource)
+    encoding_index[encoding]['videoSources'].append(videoSource)
     return 1 # same encoding, new resolution
 
+def replace_playlist(json_text, src_playlist, dst_playlist):
+    return re.sub(rf'/{src_playlist}/', f'/{dst_playlist}/', json_text)
+
 def replace_file_playlist(json_path, src_playlist, dst_playlist):
     with open(json_path, "r") as f:
         json_text = f.read()
-    json_text_new = re.sub(rf'/{src_playlist}/', f'/{dst_playlist}/', json_text)
+    json_text_new = replace_playlist(json_text, src_playlist, dst_playlist)
     with open(json_path, "w") as f:
         f.write(json_text_new)
     return json_text_new
@@ -419,41 +596,136 @@ def replace_file_server(json_path, server, replace_server):
         f.write(new_text)
     return new_text
 
-def delete_title_files(root_dir, playlist, title):
-    def del_files(src_dir, title):
-        files = glob.glob(os.path.join(src_dir, glob.escape(title)+"*"))
-        for file in files:
-            try:
-                os.remove(file)
-            except Exception as e:
-                print(f"{e}")
-        return len(files)
-    
-    # remove video
-    del_files(os.path.join(root_dir, playlist), title)
-    # remove metadata
-    del_files(os.path.join(root_dir, playlist, "metadata", "thumbnail"), title)
-    del_files(os.path.join(root_dir, playlist, "metadata", "preview"), title)
-    del_files(os.path.join(root_dir, playlist, "metadata", "seeklookup"), title)
-    del_files(os.path.join(root_dir, playlist, "metadata", "json"), title)
-
-def move_title_files(root_dir, src_playlist, dst_playlist, title):
-    def move_files(src_dir, dst_dir, title):
-        files = glob.glob(os.path.join(src_dir, glob.escape(title)+"*"))
-        for file in files:
-            try:
-                shutil.move(file, dst_dir)
-            except Exception as e:
-                print(f"{e}")
-        return len(files)
-    
-    # move video
-    move_files(os.path.join(root_dir, src_playlist), os.path.join(root_dir, dst_playlist), title)
-    # move metadata
-    move_files(os.path.join(root_dir, src_playlist, "metadata", "thumbnail"), os.path.join(root_dir, dst_playlist, "metadata", "thumbnail"), title)
-    move_files(os.path.join(root_dir, src_playlist, "metadata", "preview"), os.path.join(root_dir, dst_playlist, "metadata", "preview"), title)
-    move_files(os.path.join(root_dir, src_playlist, "metadata", "seeklookup"), os.path.join(root_dir, dst_playlist, "metadata", "seeklookup"), title)
-    move_files(os.path.join(root_dir, src_playlist, "metadata", "json"), os.path.join(root_dir, dst_playlist, "metadata", "json"), title)
+class DirListing:
+    '''sorted file names of one dir, title prefix lookup with bisect
+
+    glob per title lists and matches the whole dir, O(n^2) for a playlist
+    '''
+    def __init__(self, path):
+        self.names = sorted(os.listdir(path)) if os.path.isdir(path) else []
+    
+    def match(self, prefix):
+        i = bisect.bisect_left(self.names, prefix)
+        j = i
+        while j < len(self.names) and self.names[j].startswith(prefix):
+            j += 1
+        return self.names[i:j]
+    
+    def remove(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            del self.names[i]
+
+def find_title_files(src_dir, title, listings=None):
+    '''files of title in src_dir, same as glob title*
+
+    listings: {dir: DirListing} shared by a bulk operation, files returned are
+    taken out of the listing, the caller moves or deletes them
+    '''
+    if listings is None:
+        return glob.glob(os.path.join(src_dir, glob.escape(title)+"*"))
+    if src_dir not in listings:
+        listings[src_dir] = DirListing(src_dir)
+    names = listings[src_dir].match(title)
+    for name in names:
+        listings[src_dir].remove(name)
+    return [os.path.join(src_dir, name) for name in names]
+
+TITLE_DIRS = ["", os.path.join("metadata", "thumbnail"), os.path.join("metadata", "preview"),
+              os.path.join("metadata", "seeklookup"), os.path.join("metadata", "json"), os.path.join("metadata", "hls")]
+
+def plan_delete_title(root_dir, playlist, title, listings=None):
+    '''batch ops deleting video and metadata files of title, and its index entry
+    '''
+    ops = []
+    for sub_dir in TITLE_DIRS:
+        for file in find_title_files(os.path.join(root_dir, playlist, sub_dir), title, listings):
+            ops.append({'op': 'delete', 'path': file})
+    ops.append({'op': 'del_title', 'playlist': playlist, 'title': title})
+    return ops
+
+def plan_move_title(root_dir, src_playlist, dst_playlist, title, listings=None):
+    '''batch ops moving video and metadata files of title, json urls point to dst_playlist
+    '''
+    json_path = os.path.join(root_dir, src_playlist, "metadata", "json", f"{title}.json")
+    with open(json_path, "r") as f:
+        json_text_new = replace_playlist(f.read(), src_playlist, dst_playlist)
+    
+    ops = []
+    for sub_dir in TITLE_DIRS:
+        dst_dir = os.path.join(root_dir, dst_playlist, sub_dir)
+        for file in find_title_files(os.path.join(root_dir, src_playlist, sub_dir), title, listings):
+            ops.append({'op': 'move', 'src': file, 'dst': os.path.join(dst_dir, os.path.basename(file))})
+    ops.append({'op': 'write', 'path': os.path.join(root_dir, dst_playlist, "metadata", "json", f"{title}.json"), 'text': json_text_new})
+    ops.append({'op': 'del_title', 'playlist': src_playlist, 'title': title})
+    ops.append({'op': 'add_title', 'playlist': dst_playlist, 'video_json': json.loads(json_text_new)})
+    return ops
+
+HLS_ENCODING = 'hls'   # encoding name of the segmented renditions in the video json
+HLS_SEGMENT_TIME = 6
+HLS_BITRATES = {2880: '30M', 2160: '20M', 1920: '14M', 1440: '10M', 1080: '6M', 720: '3M'}  # transcoded rungs, by height
+
+def make_hls_ladder(video_path, output_dir, meta_data, heights=[], segment_time=HLS_SEGMENT_TIME):
+    '''segment video_path into HLS (fmp4) renditions with a master playlist, in one ffmpeg run
+
+    the source rendition is only remuxed (-c copy, cut at keyframes), heights lower than the
+    source are transcoded to h264. Layout: output_dir/master.m3u8, output_dir/<height>p/index.m3u8
+    return [(width, height, playlist path relative to output_dir)], source first, [] when ffmpeg failed
+    '''
+    has_audio = any(stream['codec_type'] == 'audio' for stream in ffmpeg.probe(video_path)['streams'])
+    renditions = [(meta_data['width'], meta_data['height'])]
+    for height in sorted(set(heights), reverse=True):
+        if height < meta_data['height']:
+            width = round(meta_data['width'] * height / meta_data['height'] / 2) * 2
+            renditions.append((width, height))
+    
+    maps, codecs, stream_map = [], [], []
+    for i, (width, height) in enumerate(renditions):
+        maps += ['-map', '0:v:0'] + (['-map', '0:a:0'] if has_audio else [])
+        if i == 0:
+            codecs += [f'-c:v:{i}', 'copy']
+            if meta_data['encoding'] == 'h265':
+                codecs += [f'-tag:v:{i}', 'hvc1']  # players only take hevc in HLS tagged hvc1
+        else:
+            bitrate = HLS_BITRATES.get(height, f"{max(width * height * 3 // 1000**2, 1)}M")
+            codecs += [f'-c:v:{i}', 'libx264', f'-filter:v:{i}', f'scale={width}:{height}', f'-b:v:{i}', bitrate,
+                       f'-maxrate:v:{i}', bitrate, f'-bufsize:v:{i}', bitrate, f'-force_key_frames:v:{i}', f'expr:gte(t,n_forced*{segment_time})']
+        stream_map.append(f"v:{i},a:{i},name:{height}p" if has_audio else f"v:{i},name:{height}p")
+    
+    make_dirs(output_dir, exist_ok=True)
+    cmd = ['ffmpeg', '-nostdin', '-y', '-i', video_path] + maps + codecs + ['-c:a', 'copy', '-preset', 'veryfast',
+           '-f', 'hls', '-hls_time', str(segment_time), '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4',
+           '-hls_flags', 'independent_segments', '-master_pl_name', 'master.m3u8', '-var_stream_map', ' '.join(stream_map),
+           '-hls_segment_filename', os.path.join(output_dir, '%v', 'seg_%05d.m4s'), os.path.join(output_dir, '%v', 'index.m3u8')]
+    print(f"Segmenting {os.path.basename(video_path)} into {len(renditions)} HLS renditions")
+    if subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode != 0:
+        print(f"ffmpeg HLS failed: {' '.join(cmd)}")
+        return []
+    return [(width, height, os.path.join(f"{height}p", 'index.m3u8')) for width, height in renditions]
+
+def add_hls_encoding(root_dir, server, playlist, encodings, video_path, meta_data, heights=[], segment_time=HLS_SEGMENT_TIME):
+    '''make the HLS ladder of a video file of playlist and add its renditions to encodings (HLS_ENCODING)
+
+    a failure (no ffprobe, unreadable file) only skips the HLS encoding, the video file is still added
+    '''
+    hls_dir = os.path.join(root_dir, playlist, 'metadata', 'hls', os.path.splitext(os.path.basename(video_path))[0])
+    try:
+        renditions = make_hls_ladder(video_path, hls_dir, meta_data, heights, segment_time)
+    except Exception as e:
+        print(f"HLS failed, skip: {e}")
+        renditions = []
+    if not renditions:
+        shutil.rmtree(hls_dir, ignore_errors=True)  # no half written segments
+    for width, height, rendition_path in renditions:
+        path = os.path.join(hls_dir, rendition_path)
+        add_encoding(encodings, HLS_ENCODING, {
+            'resolution': height,
+            'height': height,
+            'width': width,
+            'url': f"{server}/{urllib.parse.quote(os.path.relpath(path, root_dir))}",
+            'path': os.path.relpath(path, os.path.join(root_dir, playlist)),  # for check, relative so move keeps it
+        })
+    return len(renditions) > 0
 
 def ffmpeg_probe(file_path):
     print(f"FFmpeg Probing {file_path}")
@@ -478,7 +750,43 @@ def ffmpeg_probe(file_path):
     }
     return meta_data
 
-def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, seeklookup_dir, title, meta_data, screenType='flat', stereoMode='sbs', thumbnail_start_time=-1, force_thumbnail=0):
+def extract_frames_seek(video_path, timestamps, filter_str, jobs=TIMELINE_SEEK_JOBS):
+    '''one short ffmpeg per timestamp, each seeks to the keyframe before it and decodes one frame
+
+    return raw rgb24 frames, b'' where extraction failed
+    '''
+    def extract(timestamp):
+        cmd = ['ffmpeg', '-nostdin', '-y', '-noaccurate_seek', '-ss', f"{timestamp:.3f}", '-i', video_path,
+               '-frames:v', '1', '-an', '-vf', filter_str] + RAW_FRAME_ARGS
+        return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(extract, timestamps))
+
+def make_collage(frames, frame_size, grid_size, collage_size, output_file, quality=TIMELINE_QUALITY):
+    '''paste raw rgb24 frames row by row into one jpeg
+    '''
+    frame_width, frame_height = frame_size
+    frame_bytes = frame_width * frame_height * 3
+    collage = Image.new('RGB', collage_size)
+    for i, frame in enumerate(frames[:grid_size[0]*grid_size[1]]):
+        if len(frame) < frame_bytes:
+            print(f"Error: timeline frame {i+1} missing")
+            continue
+        img = Image.frombuffer('RGB', frame_size, frame[:frame_bytes], 'raw', 'RGB', 0, 1)
+        x = (i % grid_size[0]) * frame_width
+        y = (i // grid_size[0]) * frame_height
+        collage.paste(img, (x, y))
+    collage.save(output_file, quality=quality, optimize=True)
+
+def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, seeklookup_dir, title, meta_data, screenType='flat', stereoMode='sbs', thumbnail_start_time=-1, force_thumbnail=0,
+                   timeline_mode='seek', timeline_quality=TIMELINE_QUALITY):
+    '''timeline_mode: how the timeline frames are taken
+        seek: jump to each timestamp in parallel, nearest keyframe (fastest for big files)
+        keyframe: read the whole file, decode keyframes only
+        exact: decode every frame (slowest, exact timestamps)
+    timeline_quality: jpeg quality of the timeline collage
+    '''
     thumbnail_file = os.path.join(thumbnail_dir, f"{title}_thumbnail.jpg")
     videoPreview_file = os.path.join(preview_dir, f"{title}_preview.mp4")
     videoThumbnail_file = os.path.join(seeklookup_dir, f"{title}_seek.mp4")
@@ -505,7 +813,15 @@ def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, see
         crop_half_str = 'crop=iw:ih/2:0:0,'
         height //= 2
         
-    overwrite_str = '-y' if force_thumbnail & 1 else '-n'
+    # everything that needs (re)generating is done by one ffmpeg process. Each
+    # output has its own input of the same file, so only the needed parts are read:
+    # seek to the thumbnail, first seconds for the preview, keyframes for the timeline
+    ffmpeg_inputs, ffmpeg_filters, ffmpeg_outputs = [], [], []
+    def add_output(input_args, filter_str, output_args):
+        n = len(ffmpeg_filters)
+        ffmpeg_inputs.extend(input_args + ['-i', video_path])
+        ffmpeg_filters.append(f"[{n}:v]{filter_str}[v{n}]")
+        ffmpeg_outputs.extend(['-map', f'[v{n}]'] + output_args)
     
     '''thumbnail'''
     if not os.path.exists(thumbnail_file) \
@@ -517,21 +833,16 @@ def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, see
             start = seconds_to_hms(thumbnail_start_time)
         else:
             start = seconds_to_hms(meta_data['duration']//2)
-        cmd = f"ffmpeg -ss {start} -i '{video_path}' -vframes 1 -q:v 2 -vf '{crop_half_str}{scale_str}' '{thumbnail_file}' {overwrite_str}"
-        # print(cmd)
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        add_output(['-ss', start], f"{crop_half_str}{scale_str}", ['-frames:v', '1', '-q:v', '2', thumbnail_file])
     
-        
     '''video preview'''
     if not os.path.exists(videoPreview_file) \
         or force_thumbnail & 2:
         # 15s, crop to 330x200
         print("generating preview video")
         scale_str = get_scale_str(width, height, 330, 200)
-        overwrite_str = '-y' if force_thumbnail & 2 else '-n'
         last = min(meta_data['duration'], 15)
-        
-        subprocess.run(f"ffmpeg -i '{video_path}' -t {last} -an -vf '{crop_half_str}{scale_str}' -c:v libx264 -crf 23 -preset ultrafast '{videoPreview_file}' {overwrite_str}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        add_output(['-t', str(last)], f"{crop_half_str}{scale_str}", ['-an', '-c:v', 'libx264', '-crf', '23', '-preset', 'ultrafast', videoPreview_file])
     
     '''seeking preivew video'''
     if not os.path.exists(videoThumbnail_file):
@@ -543,8 +854,8 @@ def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, see
     # subprocess.run(f"ffmpeg -i '{video_path}' -an -vf 'fps={fps},{crop_half_str}{scale_str}' -c:v libx264 -crf 23 -preset ultrafast '{videoThumbnail_file}' {overwrite_str}", shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
     
     '''timeline preview'''
-    if not os.path.exists(timelinePreview_file) \
-        or force_thumbnail & 8:
+    timeline = not os.path.exists(timelinePreview_file) or force_thumbnail & 8
+    if timeline:
         # shortcut num_frames picture and composite one 4096x4096 picture
         print("generating timeline preview image")
         crop_width, crop_height = 341, 195
@@ -555,25 +866,28 @@ def make_thumbnail(root_dir, server, video_path, thumbnail_dir, preview_dir, see
         frame_interval = meta_data['duration'] / num_frames
         scale_str = get_scale_str(width, height, crop_width, crop_height)
         
-        image_temp_dir = os.path.join(seeklookup_dir, f"{title}_timelinePreview")
-        os.makedirs(image_temp_dir, exist_ok=True)
-        cmd = f"ffmpeg -i '{video_path}' -an -vf 'fps=1/{frame_interval},{crop_half_str}{scale_str}' '{image_temp_dir}'/%04d.png"
+        # timeline frames come as raw rgb24 on stdout
+        if timeline_mode == 'keyframe':
+            # decode keyframes only, the fps filter takes the nearest one for each slot
+            add_output(['-skip_frame', 'nokey'], f"fps=1/{frame_interval},{crop_half_str}{scale_str}", RAW_FRAME_ARGS)
+        elif timeline_mode == 'exact':
+            add_output([], f"fps=1/{frame_interval},{crop_half_str}{scale_str}", RAW_FRAME_ARGS)
+    
+    raw_frames = b''
+    if ffmpeg_filters:
+        cmd = ['ffmpeg', '-nostdin', '-y'] + ffmpeg_inputs + ['-filter_complex', ';'.join(ffmpeg_filters)] + ffmpeg_outputs
         # print(cmd)
-        subprocess.run(cmd, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        raw_frames = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+    
+    if timeline:
+        if timeline_mode == 'seek':
+            timestamps = [(i + 0.5) * frame_interval for i in range(num_frames)]  # middle of each slot
+            frames = extract_frames_seek(video_path, timestamps, f"{crop_half_str}{scale_str}")
+        else:
+            frame_bytes = crop_width * crop_height * 3
+            frames = [raw_frames[i:i+frame_bytes] for i in range(0, len(raw_frames), frame_bytes)]
         # composite
-        collage = Image.new('RGB', (collage_width, collage_height))
-        for i in range(num_frames):
-            try:
-                img = Image.open(f"{image_temp_dir}/{i+1:04d}.png")
-                x = (i % grid_size[0]) * crop_width
-                y = (i // grid_size[0]) * crop_height
-                collage.paste(img, (x, y))
-            except Exception as e:
-                print(f"Error: {e}")
-                break
-        collage.save(timelinePreview_file)
-        # clean
-        os.system(f"rm -rf '{image_temp_dir}'")
+        make_collage(frames, (crop_width, crop_height), grid_size, (collage_width, collage_height), timelinePreview_file, timeline_quality)
 
     return thumbnailUrl, videoPreview, videoThumbnail, timelinePreview
 
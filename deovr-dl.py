@@ -1,12 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime
+import threading
 import urllib.parse
 import os
 from lxml import html
-import requests
 import argparse
 import re
 import json
-from donwloader import sanitize_filename, seconds_to_hms, download_file, download_file_in_chunks
+import donwloader
+from donwloader import sanitize_filename, seconds_to_hms, get_remote_size, load_host_state, make_session, session_stats, \
+    parse_size, parse_schedule, set_rate_limit, HOST_STATE_FILE, stop_event
 from compatibility import get_video_data, get_video_json_from_videoData
 from db_utils import *
 
@@ -63,6 +66,17 @@ class DeoVR_DL:
         parser.add_argument('-n', '--thread-number', type=int, default=0, help='parallel download threads, 0 for original downloader')
         parser.add_argument('-K', '--chunk-size', type=int,  default=20*1024**2, help='Download in chunks of n bytes, default 20 MiB')
         parser.add_argument('-R', '--failed-repeat', type=int,  default=3, help='download failed repeat times')
+        parser.add_argument('--auto-threads', action="store_true", help='tune thread number by measured throughput, remembered per CDN host. -n is the start value for unknown host')
+        parser.add_argument('--max-threads', type=int, default=16, help='upper limit of threads when --auto-threads')
+        parser.add_argument('--host-state-file', default=HOST_STATE_FILE, help='file remembering best thread number per CDN host')
+        parser.add_argument('-j', '--jobs', type=int, default=1, help='playlist videos downloaded at the same time')
+        parser.add_argument('--max-connections', type=int, default=0, help='limit total connections of all jobs, default 0 no limit')
+        parser.add_argument('--no-preallocate', action="store_true", help='don\'t reserve the whole file before multi thread download (sparse file, may fragment)')
+        parser.add_argument('--check-disk-space', action="store_true", help='fail fast when the disk can\'t hold the file')
+        parser.add_argument('--limit-rate', type=parse_size, default=0, help='limit total download speed of all threads and jobs, e.g. 500K, 10M. default 0 no limit')
+        parser.add_argument('--limit-schedule', type=parse_schedule, default=[], help='time of day limits overriding --limit-rate, e.g. "08:00-23:00=2M,23:00-08:00=0"')
+        parser.add_argument('--engine', default='thread', choices=['thread', 'async'], help='download engine, async needs aiohttp and multiplexes all connections on one event loop')
+        parser.add_argument('--metadata-jobs', type=int, default=8, help='parallel requests when fetching playlist pages and video json')
         
         # hosting mode
         parser.add_argument('-H', '--hosting-mode', action="store_true", help='normal mode: download single video. Hosting mode: download and organize')
@@ -71,6 +85,9 @@ class DeoVR_DL:
         parser.add_argument('-S', '--server', default="http://localhost:8000", help='HTTP server address hosting the video files')
         
         parser.add_argument('-E', '--force-metadata', action="store_true", help='force download missed metadata, don\'t download video')
+        parser.add_argument('--hls', action="store_true", help='after download, segment the video into HLS (remux, no re-encoding), added as encoding `hls`')
+        parser.add_argument('--hls-ladder', type=int, nargs='+', default=[], help='also transcode these lower heights into the HLS ladder, e.g. --hls-ladder 1440 1080')
+        parser.add_argument('--hls-time', type=int, default=HLS_SEGMENT_TIME, help='HLS segment duration in seconds')
         args = parser.parse_args()
         return args
     
@@ -81,20 +98,30 @@ class DeoVR_DL:
         if not os.path.exists(args.root_dir):
             os.makedirs(args.root_dir, exist_ok=True)
 
-        headers = {
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36 Edg/127.0.0.0'
-        }
         cookies = {}
         if args.cookie_file:
             cookies = parseCookieFile(args.cookie_file)
-        self.session = requests.Session()
-        self.session.headers.update(headers)
-        self.session.cookies.update(cookies)
+        # every concurrent request keeps its connection alive, across ranges, files and metadata
+        threads = args.max_threads if args.auto_threads else max(args.thread_number, 1)
+        pool_size = max(threads * args.jobs, args.metadata_jobs)
+        if args.max_connections > 0:
+            pool_size = min(pool_size, args.max_connections)
+        self.session = make_session(pool_size, cookies)
         
         if args.server.endswith('/'):
             self.server = args.server[:-1]
         else:
             self.server = args.server
+        
+        self.db_lock = threading.Lock()  # id assignment and library update from concurrent jobs
+        self.web_support = True
+        if args.engine == 'async':
+            import async_downloader
+            self.engine = async_downloader
+        else:
+            self.engine = donwloader
+        self.engine.set_max_connections(args.max_connections)
+        set_rate_limit(args.limit_rate, args.limit_schedule)
     
     def run(self):
         args = self.parse_args()
@@ -108,10 +135,10 @@ class DeoVR_DL:
         elif type == 1:
             print('Download Single video')
             self.download_single_video(json_data)
+            self.print_connection_stats()
         else:
             print('Download Playlist')
             page_num = json_data['page_num']
-            web_support = True
             
             start_page, end_page = self.args.playlist_range.split(':')
             start_page = 1 if start_page=='' else int(start_page)
@@ -121,32 +148,103 @@ class DeoVR_DL:
             if end_page < 0:
                 end_page += page_num + 1
             print(f"download range: {start_page}:{end_page}")
+            plan = self.build_plan(json_data, start_page, end_page)
+            
+            executor = ThreadPoolExecutor(max_workers=self.args.jobs)
+            futures = set()
+            try:
+                for i, video_json in enumerate(plan):
+                    # bounded pipeline, don't run ahead of the running jobs
+                    while len(futures) >= self.args.jobs:
+                        _, futures = wait(futures, return_when=FIRST_COMPLETED)
+                    futures.add(executor.submit(self.download_playlist_video, video_json, f"{i+1}/{len(plan)}"))
+                wait(futures)
+            except KeyboardInterrupt:
+                print("KeyboardInterrupt, stopping jobs")
+                stop_event.set()
+                executor.shutdown(wait=True, cancel_futures=True)
+                exit(0)
+            executor.shutdown()
+            self.print_connection_stats()
+    
+    def print_connection_stats(self):
+        stats = session_stats(self.session)
+        print(f"Connections: opened {stats['opened']}, reused {stats['reused']}, requests {stats['requests']}")
+    
+    def build_plan(self, json_data, start_page, end_page):
+        '''fetch all pages, video json and file sizes before downloading any video
+        '''
+        def try_result(future, what):
+            try:
+                return future.result()
+            except (Exception, SystemExit) as e:
+                print(f"Get {what} failed: {e}")
+                return None
+        
+        print(f"\nFetching metadata")
+        with ThreadPoolExecutor(max_workers=self.args.metadata_jobs) as executor:
+            page_futures = {page: executor.submit(self.parse_one_page, self.args.url, page) for page in range(start_page, end_page + 1) if page != 1}
+            videos = []
             for page in range(start_page, end_page + 1):
-                print(f"\nDownloading page {page}/{page_num}")
-                if page == 1:
-                    videos = json_data['page_1']
+                page_videos = json_data['page_1'] if page == 1 else try_result(page_futures[page], f"page {page}")
+                videos += page_videos or []
+            print(f"** Pages: {end_page - start_page + 1}, videos: {len(videos)}")
+            
+            json_futures = [executor.submit(self.get_playlist_video_json, video) for video in videos]
+            plan = []
+            for video, future in zip(videos, json_futures):
+                video_json = try_result(future, f"video {video[1]}")
+                if video_json:
+                    plan.append(video_json)
                 else:
-                    videos = self.parse_one_page(self.args.url, page)
-                
-                for i, video in enumerate(videos):
-                    video_id, video_href = video
-                    print(f"\nDownloading video {i+1}/{len(videos)}")
-                    
-                    if web_support:
-                        code, video_json = self.get_video_json_from_id(video_id)
-                        if code==1:
-                            web_support = False
-                            video_json = self.get_video_json_from_href(video_href)
-                        elif code==2: # dirty fix, for some video, video json get empty url, but videoData contain url
-                            video_json_tmp = self.get_video_json_from_href(video_href)
-                            if video_json_tmp and video_json_tmp['encodings']:
-                                video_json['encodings'] = video_json_tmp['encodings']
-                    else:
-                        video_json = self.get_video_json_from_href(video_href)
-                    
-                    # with open('current.json', 'w') as f:
-                    #     json.dump(video_json, f, indent=4)
-                    self.download_single_video(video_json)
+                    print(f"Empty video json {video[1]}, skip")
+            
+            # size of the files still to download
+            size_futures = []
+            for video_json in plan:
+                for selected_src in self.select_formats(self.get_src_list(video_json)):
+                    output_dir = os.path.join(self.root_dir, self.args.playlist) if self.args.hosting_mode else self.root_dir
+                    output_file, _, _ = self.get_video_files(self.get_title(video_json), output_dir, selected_src)
+                    if os.path.exists(output_file) and not self.args.overwrite:
+                        continue
+                    size_futures.append((selected_src['url'], executor.submit(get_remote_size, self.session, selected_src['url'])))
+            total_size = 0
+            host_size = {}
+            for url, future in size_futures:
+                size = try_result(future, f"size of {url}") or -1
+                if size > 0:
+                    total_size += size
+                    host = urllib.parse.urlsplit(url).hostname
+                    host_size[host] = host_size.get(host, 0) + size
+        
+        print(f"** Files to download: {len(size_futures)}, total {total_size:,} bytes|{total_size/1024**3:.2f} GiB")
+        host_state = load_host_state(self.args.host_state_file)
+        if host_size and all(host in host_state for host in host_size):
+            eta = sum(size / host_state[host]['speed'] for host, size in host_size.items())
+            print(f"** ETA: {seconds_to_hms(eta)} (remembered speed)")
+        return plan
+    
+    def get_playlist_video_json(self, video):
+        video_id, video_href = video
+        if self.web_support:
+            code, video_json = self.get_video_json_from_id(video_id)
+            if code==1:
+                self.web_support = False
+                video_json = self.get_video_json_from_href(video_href)
+            elif code==2: # dirty fix, for some video, video json get empty url, but videoData contain url
+                video_json_tmp = self.get_video_json_from_href(video_href)
+                if video_json_tmp and video_json_tmp['encodings']:
+                    video_json['encodings'] = video_json_tmp['encodings']
+        else:
+            video_json = self.get_video_json_from_href(video_href)
+        return video_json
+    
+    def download_playlist_video(self, video_json, progress):
+        print(f"\nDownloading video {progress}")
+        try:
+            self.download_single_video(video_json)
+        except Exception as e:
+            print(f"Download video {video_json['title']} failed: {e}")
        
     def parse_url(self, url):
         response = self.get(url)
@@ -285,15 +383,34 @@ class DeoVR_DL:
         # sort by quality then encoding priority
         filter_src.sort(key=lambda x: (int(x['quality'][:-1]), -self.args.encodings.index(x['encoding']) if x['encoding'] in self.args.encodings else -len(self.args.encodings)))
         # self.print_formats(filter_src)
+        if len(filter_src) == 0:
+            return []
         best_src = filter_src[-1]
         if self.args.max_quality > 0:
             filter_src = [src for src in filter_src if int(src['quality'][:-1]) <= self.args.max_quality]
+        if len(filter_src) == 0:
+            return []
         best2_src = filter_src[-1]
         if best_src != best2_src and self.args.also_download_best_quality:
             print(f"Also download the best quality: {best_src['quality']}")
             return [best_src, best2_src]
         return [best2_src]
 
+    def get_title(self, video_json):
+        # title_id as identifier
+        if self.args.title:
+            return self.args.title
+        return f"{sanitize_filename(video_json['title'])} [{video_json['id']}]"
+    
+    def get_video_files(self, title, output_dir, selected_src):
+        '''video file, its temp file and recover file
+        '''
+        filename = f"{title} - {selected_src['encoding']} {selected_src['quality']}"
+        output_file = os.path.join(output_dir, f"{filename}.mp4")
+        output_tmp_file = os.path.join(output_dir, f"{filename}.mp4.tmp")
+        recover_file = os.path.join(output_dir, f"{filename}.recover.json")
+        return output_file, output_tmp_file, recover_file
+    
     def download_single_video(self, video_json):
         if not video_json:
             print('Empty video json, skip')
@@ -301,10 +418,7 @@ class DeoVR_DL:
         # print metadata
         self.print_metadata(video_json)
         
-        # title_id as identifier
-        title = f"{sanitize_filename(video_json['title'])} [{video_json['id']}]"
-        if self.args.title:
-            title = self.args.title
+        title = self.get_title(video_json)
         
         # format select
         src_list = self.get_src_list(video_json)
@@ -325,10 +439,8 @@ class DeoVR_DL:
 
         for selected_src in selected_srcs:
             # hosting mode
-            db_json = read_db_json(self.root_dir)
             dump_json = video_json.copy()
             dump_json['title'] = title
-            dump_json['id'] = get_current_id(db_json)
             dump_json['ext'] = '.mp4'
             del dump_json['encodings']
         
@@ -365,6 +477,10 @@ class DeoVR_DL:
                 
                 add_encoding(video_json_ori['encodings'], selected_src['encoding'],
                                 self.get_videoSource(selected_src))
+                
+                if self.args.hls:
+                    add_hls_encoding(self.root_dir, self.server, playlist, video_json_ori['encodings'], video_path, selected_src,
+                                     heights=self.args.hls_ladder, segment_time=self.args.hls_time)
             
             # download metadata (after video download, if we don't download video, we don't need metadata)
             print("Downloading metadata")
@@ -372,32 +488,32 @@ class DeoVR_DL:
             
             # self extended key, top playlist json will use it
             dump_json['video_url'] = f"{self.server}/{playlist}/metadata/json/{title}.json"  # test, it's ok
-            video_json_ori.update(dump_json)
             
-            # save video json
-            print("Save single video json")
-            write_video_json(self.root_dir, playlist, title, video_json_ori)
-            
-            # add to db
-            print("Add to top json")
-            db_add_title(db_json, playlist, video_json_ori)
-            write_db_json(self.root_dir, db_json)
+            library = open_library(self.root_dir)
+            with self.db_lock, library.batch():
+                dump_json['id'] = library.get_current_id()
+                video_json_ori.update(dump_json)
+                
+                # save video json
+                print("Save single video json")
+                write_video_json(self.root_dir, playlist, title, video_json_ori)
+                
+                # add to db
+                print("Add to top json")
+                library.add_title(playlist, video_json_ori)
        
     def download_video(self, title, output_dir, selected_src):
         succ = True
-        filename = f"{title} - {selected_src['encoding']} {selected_src['quality']}"
-        output_file = os.path.join(output_dir, f"{filename}.mp4")
-        output_tmp_file = os.path.join(output_dir, f"{filename}.mp4.tmp")
-        recover_file = os.path.join(output_dir, f"{filename}.recover.json")
+        output_file, output_tmp_file, recover_file = self.get_video_files(title, output_dir, selected_src)
         
         # print selected
         print(f"Downloading Video:")
         print(f"** Select encoding: {selected_src['encoding']}")
         print(f"** Selected quality: {selected_src['quality']}")
         print(f"** Save to: {output_file}")
-        if self.args.thread_number!=0:
+        if self.args.thread_number!=0 or self.args.auto_threads:
             print(f"** Chunk size {self.args.chunk_size/1024**2:.2f} MiB")
-            print(f"** Threads: {self.args.thread_number}")
+            print(f"** Threads: {'auto' if self.args.auto_threads else self.args.thread_number}")
         
         if os.path.exists(output_file):
             if self.args.overwrite:
@@ -411,17 +527,24 @@ class DeoVR_DL:
                 print('Skip')
                 return output_file, False
         
-        if self.args.thread_number == 0:
-            succ = download_file(self.session, selected_src['url'], output_file, print_info=True, repeat=self.args.failed_repeat)
+        checksum = {}
+        if self.args.thread_number == 0 and not self.args.auto_threads:
+            succ = self.engine.download_file(self.session, selected_src['url'], output_file, print_info=True, repeat=self.args.failed_repeat, checksum=checksum)
         else:
-            succ = download_file_in_chunks(self.session, selected_src['url'], output_file=output_tmp_file, recover_file=recover_file, \
-                max_threads=self.args.thread_number, chunk_size=self.args.chunk_size, repeat=self.args.failed_repeat)
+            succ = self.engine.download_file_in_chunks(self.session, selected_src['url'], output_file=output_tmp_file, recover_file=recover_file, \
+                max_threads=self.args.thread_number or 4, chunk_size=self.args.chunk_size, repeat=self.args.failed_repeat, \
+                auto_threads=self.args.auto_threads, max_auto_threads=self.args.max_threads, state_file=self.args.host_state_file, \
+                preallocate=not self.args.no_preallocate, check_space=self.args.check_disk_space, checksum=checksum)
             if succ:
                 print('Download successed')
                 os.rename(output_tmp_file, output_file)
                 print(f"File size: {os.path.getsize(output_file):,} bytes")
             else:
                 print('Download failed, run again to recover')
+        if succ and 'crc32' in checksum:
+            # keep it in the video json, so the file can be checked later without the remote
+            selected_src['crc32'] = checksum['crc32']
+            selected_src['size'] = checksum['size']
         return output_file, succ
     
     def download_others(self, video_json, dump_json, title, thumbnail_dir, preview_dir, seeklookup_dir):
@@ -429,7 +552,7 @@ class DeoVR_DL:
         # The field ‘thumbnailUrl’ should contain the link to the file with the image shown in the list. This field is required in case of using the list.
         output_path = os.path.join(thumbnail_dir, f"{title}_thumbnail.jpg")
         if not os.path.exists(output_path):
-            download_file(self.session, video_json['thumbnailUrl'], output_path, repeat=repeat)
+            self.engine.download_file(self.session, video_json['thumbnailUrl'], output_path, repeat=repeat)
         url_path = urllib.parse.quote(os.path.relpath(output_path, self.root_dir))
         dump_json['thumbnailUrl'] = f"{self.server}/{url_path}"
         
@@ -437,7 +560,7 @@ class DeoVR_DL:
         if 'videoPreview' in video_json:
             output_path = os.path.join(preview_dir, f"{title}_preview.mp4")
             if not os.path.exists(output_path):
-                download_file(self.session, video_json['videoPreview'], output_path, repeat=repeat)
+                self.engine.download_file(self.session, video_json['videoPreview'], output_path, repeat=repeat)
             url_path = urllib.parse.quote(os.path.relpath(output_path, self.root_dir))
             dump_json['videoPreview'] = f"{self.server}/{url_path}"
         
@@ -446,7 +569,7 @@ class DeoVR_DL:
             # !!! obsolescent, not used
             # output_path = os.path.join(seeklookup_dir, f"{title}_seek.mp4")
             # if not os.path.exists(output_path):
-            #     download_file(self.session, video_json['videoThumbnail'], output_path, repeat=repeat)
+            #     self.engine.download_file(self.session, video_json['videoThumbnail'], output_path, repeat=repeat)
             # url_path = urllib.parse.quote(os.path.relpath(output_path, self.root_dir))
             # dump_json['videoThumbnail'] =f"{self.server}/{url_path}"
             dump_json['videoThumbnail'] = ""
@@ -454,17 +577,21 @@ class DeoVR_DL:
         if 'timelinePreview' in video_json:
             output_path = os.path.join(seeklookup_dir, f"{title}_4096_timelinePreview341x195.jpg")
             if not os.path.exists(output_path):
-                download_file(self.session, video_json['timelinePreview'], output_path, repeat=repeat)
+                self.engine.download_file(self.session, video_json['timelinePreview'], output_path, repeat=repeat)
             url_path = urllib.parse.quote(os.path.relpath(output_path, self.root_dir))
             dump_json['timelinePreview'] =f"{self.server}/{url_path}"
     
     def get_videoSource(self, selected_src):
-        return {
+        videoSource = {
             'url': selected_src['url'],
             'resolution': selected_src['resolution'],
             'height': selected_src['height'],
             'width': selected_src['width']
         }
+        if 'crc32' in selected_src:
+            videoSource['crc32'] = selected_src['crc32']
+            videoSource['size'] = selected_src['size']
+        return videoSource
 
 if __name__ == '__main__':
     downloader = DeoVR_DL()
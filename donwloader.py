@@ -1,9 +1,22 @@
+import ctypes
+import errno
 import json
 import os
 import queue
 import re
+import shutil
+import sys
 import threading
 import time
+import urllib.parse
+import zlib
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_HEADERS = {
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36 Edg/127.0.0.0'
+}
+POOL_HOSTS = 32  # hosts kept in the pool manager, an evicted host loses its keep-alive connections
 
 def sanitize_filename(filename):
     # windows forbidden characters
@@ -18,15 +31,37 @@ def seconds_to_hms(seconds):
     secs = seconds % 60
     return f"{hours:02}:{minutes:02}:{secs:02}"
 
+def make_session(pool_size=10, cookies=None):
+    '''requests session whose keep-alive pool holds pool_size connections per host
+
+    Size it to the number of concurrent requests, otherwise connections over the
+    pool size are closed after each range and every new range pays a TLS handshake.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=max(pool_size, 1))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update(DEFAULT_HEADERS)
+    if cookies:
+        session.cookies.update(cookies)
+    return session
+
+def session_stats(session):
+    '''connections opened vs requests that reused a kept-alive connection
+    '''
+    opened = requests_num = 0
+    for adapter in set(session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            opened += pool.num_connections
+            requests_num += pool.num_requests
+    return {'opened': opened, 'requests': requests_num, 'reused': requests_num - opened}
+
 def download_chunk_helper(session, url, start, end, stream=True):
-    headers = {
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/127.0.0.0 Safari/537.36 Edg/127.0.0.0'
-    }
+    # user-agent is a session header (make_session), only the range changes per request
     end = '' if end == -1 else end
-    range_header = f'bytes={start}-{end}'
-    chunk_headers = headers.copy()
-    chunk_headers['Range'] = range_header
-    response = session.get(url, headers=chunk_headers, stream=stream, timeout=(10, 20))  # set timeout, so don't hang long time
+    response = session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=stream, timeout=(10, 20))  # set timeout, so don't hang long time
     return response
 
 def print_speed(seconds, total_size):
@@ -34,29 +69,76 @@ def print_speed(seconds, total_size):
     print(f"Downloaded {total_size:,} bytes")
     print(f"Elapsed time: {seconds_to_hms(seconds)} Speed: {speed/1024**2:.2f} MiB/s")
     
-def download_file(session, url, output_file='output.mp4', print_info=False, repeat=1):
+def download_file(session, url, output_file='output.mp4', print_info=False, repeat=1, checksum=None):
     '''donwload file single thread
+
+    The file is written as output_file.part and renamed when complete, so a failed
+    download never sits at the final name, where the next run would skip it as done.
+    checksum: dict, filled with crc32/size/etag of the downloaded file
     '''
+    if not acquire_connection():
+        return False
+    part_file = output_file + PART_SUFFIX
+    succ = False
+    try:
+        succ = download_file_helper(session, url, part_file, print_info, repeat, checksum)
+        if succ:
+            os.replace(part_file, output_file)
+        return succ
+    finally:
+        release_connection()
+        if not succ:
+            # failed, stopped or interrupted, only the chunked path keeps partial data
+            remove_part_file(part_file)
+
+def remove_part_file(part_file):
+    if os.path.exists(part_file):
+        os.remove(part_file)
+
+def download_file_helper(session, url, output_file, print_info, repeat, checksum=None):
     while True:
         repeat -= 1
         try:
             tic = time.time()
+            crc = 0
             response = download_chunk_helper(session, url, 0, -1)
+            if response.status_code in RETRY_STATUS and repeat > 0:
+                response.close()
+                retry_after = response.headers.get('Retry-After', '')
+                wait = int(retry_after) if retry_after.isdigit() else 2
+                print(f"HTTP response code {response.status_code}, retry after {wait}s, repeat {repeat}")
+                time.sleep(min(wait, 60))
+                continue
+            if response.status_code not in [200, 206]:
+                # don't save an error page as the video
+                response.close()
+                print(f"Error: HTTP response code {response.status_code}, {url}")
+                return False
+            # Content-Length is the encoded size when the server compresses
+            expected_size = int(response.headers['Content-Length']) if 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers else None
             with open(output_file, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024**2):
+                for chunk in response.iter_content(chunk_size=rate_limiter.block_size(1024**2)):
+                    if stop_event.is_set():
+                        response.close()
+                        return False
+                    rate_limiter.consume(len(chunk))
                     if chunk:
                         f.write(chunk)
+                        crc = zlib.crc32(chunk, crc)
                         downloaded_bytes = f.tell()
                         if print_info:
                             print(f"Downloaded {downloaded_bytes:,} bytes avg: {downloaded_bytes/(time.time()-tic)/1024**2:4.2f} MiB/s", end='\r')
                 total_size = f.tell()
+            if expected_size is not None and total_size != expected_size:
+                raise Exception(f"incomplete file, got {total_size:,}/{expected_size:,} bytes")
             if print_info:
                 print_speed(time.time() - tic, total_size)
+            if checksum is not None:
+                checksum.update({'crc32': f"{crc:08x}", 'size': total_size, 'etag': response.headers.get('ETag', '')})
             
             return True
         except KeyboardInterrupt:
             print("KeyboardInterrupt")
-            os.path.remove(output_file)
             return False
         except Exception as e:
             print(f"Exception {e}, repeat {repeat}")
@@ -64,92 +146,762 @@ def download_file(session, url, output_file='output.mp4', print_info=False, repe
                 return False
 
 stop_event = threading.Event()
-def download_chunk_thread(session, tid, result_queue, shared_data, lock, task_queue, repeat=1):
-    while not stop_event.is_set():
-        with lock:
-            if task_queue.empty():
-                break
-            chunk_id, start, end = task_queue.get()
-        print(f"{f'Thread {tid}: Downloading chunck':<30s} {chunk_id:3d}/{shared_data['chunk_num']:<3d}")
+connection_slots = None  # process wide connection limit shared by all downloads, see set_max_connections
+PART_SUFFIX = '.part'  # single stream downloads, the chunked ones use .tmp with a recover file
+STREAM_BLOCK_SIZE = 256 * 1024  # bytes read from socket per write, bounds memory per thread
+write_lock = threading.Lock()   # only used when os.pwrite is not available (windows)
+
+def parse_size(text):
+    '''"500K", "10M", "1.5GiB" -> bytes, plain numbers are bytes
+    '''
+    m = re.fullmatch(r'\s*([\d.]+)\s*([kmg]?)(i?b?)\s*', text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"bad size {text}")
+    unit = {'': 1, 'k': 1024, 'm': 1024**2, 'g': 1024**3}[m.group(2).lower()]
+    return int(float(m.group(1)) * unit)
+
+def parse_schedule(text):
+    '''"08:00-23:00=2M,23:00-08:00=0" -> [(start_minute, end_minute, rate)], rate 0 is no limit
+    '''
+    def minutes(hm):
+        h, m = hm.split(':')
+        return int(h) * 60 + int(m)
+    schedule = []
+    for item in text.split(','):
+        if not item.strip():
+            continue
+        span, rate = item.split('=')
+        start, end = span.split('-')
+        schedule.append((minutes(start), minutes(end), parse_size(rate)))
+    return schedule
+
+class RateLimiter:
+    '''token bucket shared by every download thread and file of the process
+
+    Tokens may go negative, a reader then sleeps until its bytes are paid for,
+    so many small waits keep the rate smooth instead of bursting every second.
+    '''
+    BURST_SECONDS = 0.5
+    
+    def __init__(self, rate=0, schedule=None):
+        self.rate = rate  # bytes per second, 0 no limit
+        self.schedule = schedule or []
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def current_rate(self):
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for start, end, rate in self.schedule:
+            if start <= end and start <= minute < end:
+                return rate
+            if start > end and (minute >= start or minute < end):  # over midnight
+                return rate
+        return self.rate
+    
+    def block_size(self, default):
+        '''read size, small enough to get about 10 waits per second
+        '''
+        rate = self.current_rate()
+        if rate <= 0:
+            return default
+        return max(min(default, rate // 10), 1024)
+    
+    def reserve(self, nbytes):
+        '''take nbytes from the bucket, return seconds the caller has to wait
+        '''
+        rate = self.current_rate()
+        if rate <= 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.last) * rate, rate * self.BURST_SECONDS)
+            self.last = now
+            self.tokens -= nbytes
+            return 0 if self.tokens >= 0 else -self.tokens / rate
+    
+    def consume(self, nbytes):
+        wait = self.reserve(nbytes)
+        if wait > 0:
+            time.sleep(wait)
+
+rate_limiter = RateLimiter()
+
+def set_rate_limit(rate=0, schedule=None):
+    rate_limiter.rate = rate
+    rate_limiter.schedule = schedule or []
+
+def set_max_connections(max_connections):
+    global connection_slots
+    connection_slots = threading.BoundedSemaphore(max_connections) if max_connections > 0 else None
+
+def acquire_connection():
+    '''wait for a free connection slot, False if stopped while waiting
+    '''
+    while connection_slots is not None and not connection_slots.acquire(timeout=0.5):
+        if stop_event.is_set():
+            return False
+    return True
+
+def release_connection():
+    if connection_slots is not None:
+        connection_slots.release()
+
+def open_output_fd(output_file, truncate=True):
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+    if truncate:
+        flags |= os.O_TRUNC
+    return os.open(output_file, flags, 0o644)
+
+def write_at(fd, data, offset):
+    '''positional write on a shared fd, safe to call from multiple threads
+    '''
+    data = memoryview(data)
+    while len(data) > 0:
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, data, offset)
+        else:
+            with write_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, data)
+        data = data[n:]
+        offset += n
+
+class RemoteChanged(Exception):
+    '''remote file isn't the one we started with, retry can't help
+    '''
+
+def crc32_combine(crc1, crc2, len2):
+    '''crc32 of A+B from crc32(A), crc32(B) and len(B), port of zlib crc32_combine
+    '''
+    def gf2_times(mat, vec):
+        total, i = 0, 0
+        while vec:
+            if vec & 1:
+                total ^= mat[i]
+            vec >>= 1
+            i += 1
+        return total
+    
+    def gf2_square(mat):
+        return [gf2_times(mat, mat[n]) for n in range(32)]
+    
+    if len2 <= 0:
+        return crc1
+    odd = [0xedb88320] + [1 << n for n in range(31)]  # operator for one zero bit
+    even = gf2_square(odd)  # two zero bits
+    odd = gf2_square(even)  # four zero bits
+    while True:
+        # apply len2 zero bytes to crc1
+        even = gf2_square(odd)
+        if len2 & 1:
+            crc1 = gf2_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = gf2_square(even)
+        if len2 & 1:
+            crc1 = gf2_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+def check_range_response(headers, pos, end, total_size, etag):
+    '''206 response must be the bytes we asked for, of the file we started with
+    '''
+    content_range = headers.get('Content-Range', '')
+    m = re.fullmatch(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range)
+    if not m or int(m.group(1)) != pos or int(m.group(2)) > end:
+        raise Exception(f"bad Content-Range '{content_range}', requested {pos}-{end}")
+    if m.group(3) != '*' and int(m.group(3)) != total_size:
+        raise RemoteChanged(f"remote size changed {total_size:,} -> {int(m.group(3)):,}")
+    if etag and headers.get('ETag') and headers.get('ETag') != etag:
+        raise RemoteChanged(f"remote ETag changed {etag} -> {headers.get('ETag')}")
+    content_length = headers.get('Content-Length')
+    if content_length and int(content_length) != int(m.group(2)) - pos + 1:
+        raise Exception(f"Content-Length {content_length} doesn't match Content-Range '{content_range}'")
+
+class RecoverJournal:
+    '''bytes persisted per range, saved to the recover file
+
+    format: {"total_size": N, "etag": "...", "ranges": [[pos, end], ...],
+    "segments": [[start, end, crc32], ...]}, every range still needs bytes
+    pos..end (inclusive), segments are the bytes written with their crc32.
+    Positions are only saved after the data before them is fsynced, so resume
+    never skips bytes that were lost.
+    '''
+    def __init__(self, recover_file, fd, total_size, etag='', fsync=True):
+        self.recover_file = recover_file
+        self.fd = fd
+        self.total_size = total_size
+        self.etag = etag
+        self.fsync = fsync
+        self.ranges = {}    # range id -> [pos, end, segment start, crc32 of segment start..pos-1]
+        self.segments = []  # [start, end, crc32] finished, None if unknown (old recover file)
+        self.lock = threading.Lock()
+    
+    def snapshot(self):
+        '''remaining [pos, end] ranges, call with lock held
+        '''
+        return sorted([r[0], r[1]] for r in self.ranges.values() if r[0] <= r[1])
+    
+    def segment_snapshot(self):
+        '''written [start, end, crc32] pieces, call with lock held
+        '''
+        if self.segments is None:
+            return None
+        return sorted(self.segments + [[r[2], r[0] - 1, r[3]] for r in self.ranges.values() if r[0] > r[2]])
+    
+    def file_crc32(self):
+        '''crc32 of the whole file from the segments, None if they don't cover it exactly
+        '''
+        with self.lock:
+            segments = self.segment_snapshot()
+        if segments is None:
+            return None
+        crc, pos = 0, 0
+        for start, end, seg_crc in segments:
+            if start != pos:
+                print(f"Segments don't tile the file at {pos:,}: next segment {start:,}-{end:,}")
+                return None
+            crc = crc32_combine(crc, seg_crc, end - start + 1)
+            pos = end + 1
+        if pos != self.total_size:
+            print(f"Segments end at {pos:,}, file size {self.total_size:,}")
+            return None
+        return crc
+    
+    def remain_bytes(self):
+        with self.lock:
+            return sum(end - pos + 1 for pos, end in self.snapshot())
+    
+    def save(self):
+        if not self.recover_file:
+            return
+        with self.lock:
+            ranges = self.snapshot()
+            segments = self.segment_snapshot()
+        if self.fsync:
+            os.fsync(self.fd)
+        tmp_file = f"{self.recover_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump({'total_size': self.total_size, 'etag': self.etag, 'ranges': ranges, 'segments': segments}, f)
+        os.replace(tmp_file, self.recover_file)  # never leave a half written journal
+    
+    def remove(self):
+        if self.recover_file and os.path.exists(self.recover_file):
+            os.remove(self.recover_file)
+
+def load_recover_ranges(recover_data, total_size, etag, start_offset, chunk_size):
+    '''remaining [pos, end] ranges and written segments from a recover file
+
+    (None, None) if it can't be used, segments are None when the file doesn't have them
+    '''
+    if isinstance(recover_data, dict):
+        if recover_data.get('total_size') != total_size:
+            return None, None
+        if etag and recover_data.get('etag') and recover_data['etag'] != etag:
+            return None, None
+        return [tuple(r) for r in recover_data['ranges']], recover_data.get('segments')
+    if isinstance(recover_data, list):
+        # old format: list of finished chunk ids
+        ranges = []
+        for chunk_id, start in enumerate(range(start_offset, total_size, chunk_size)):
+            if chunk_id not in recover_data:
+                ranges.append((start, min(start + chunk_size - 1, total_size - 1)))
+        return ranges, None
+    return None, None
+
+MIN_SPLIT_SIZE = 1024**2       # don't steal from a range with less than 2x this left
+RANGE_TARGET_SECONDS = 20      # adaptive range size aims at this much transfer time
+MAX_RANGE_FACTOR = 8           # adaptive range size never exceeds chunk_size * this
+
+class RangeScheduler(RecoverJournal):
+    '''hands out byte ranges to worker threads
+
+    Pending regions are cut into ranges sized per worker from its measured
+    throughput. When nothing is pending, an idle worker steals the second half
+    of the in-flight range with most bytes left, so the download doesn't end
+    with one slow connection finishing a big chunk alone.
+    '''
+    def __init__(self, recover_file, fd, total_size, chunk_size, etag='', fsync=True):
+        super().__init__(recover_file, fd, total_size, etag=etag, fsync=fsync)
+        self.chunk_size = chunk_size
+        self.pending = []     # [pos, end] regions not handed out yet
+        self.active = {}      # range id -> tid
+        self.range_size = {}  # tid -> next range size
+        self.next_id = 0
+        self.written = 0      # bytes written this run, includes unfinished ranges
+    
+    def add_region(self, pos, end):
+        with self.lock:
+            self.pending.append([pos, end])
+    
+    def snapshot(self):
+        # pending regions must be in the journal too
+        return sorted(super().snapshot() + [list(r) for r in self.pending])
+    
+    def next_range(self, tid):
+        '''return (range_id, pos, end), or None when nothing left worth splitting
+        '''
+        with self.lock:
+            if self.pending:
+                size = self.range_size.get(tid, self.chunk_size)
+                # near the end, spread what is left over the working threads (not the ones parked by the controller)
+                pending_bytes = sum(end - pos + 1 for pos, end in self.pending)
+                workers = len(set(self.active.values()) | {tid})
+                size = max(min(size, pending_bytes // workers), MIN_SPLIT_SIZE)
+                region = self.pending[0]
+                pos = region[0]
+                end = min(pos + size - 1, region[1])
+                region[0] = end + 1
+                if region[0] > region[1]:
+                    self.pending.pop(0)
+            else:
+                # work stealing
+                victim, remain = None, 0
+                for range_id in self.active:
+                    r = self.ranges[range_id]
+                    if r[1] - r[0] + 1 > remain:
+                        victim, remain = range_id, r[1] - r[0] + 1
+                # the victim may be writing one block past its position, keep the split beyond it
+                if victim is None or remain // 2 < max(MIN_SPLIT_SIZE, STREAM_BLOCK_SIZE):
+                    return None
+                r = self.ranges[victim]
+                pos = r[0] + remain // 2
+                end = r[1]
+                r[1] = pos - 1
+            range_id = self.next_id
+            self.next_id += 1
+            self.ranges[range_id] = [pos, end, pos, 0]
+            self.active[range_id] = tid
+            return range_id, pos, end
+    
+    def end_of(self, range_id):
+        with self.lock:
+            return self.ranges[range_id][1]
+    
+    def update(self, range_id, pos, crc):
+        '''record written position and crc32 up to it, return the range end (may shrink when stolen)
+        '''
+        with self.lock:
+            r = self.ranges[range_id]
+            self.written += pos - r[0]
+            r[0] = pos
+            r[3] = crc
+            return r[1]
+    
+    def write_head(self, data):
+        '''write the probed first bytes, they are a segment too
+
+        pending regions are cut to start after them, so the head is never
+        downloaded and recorded twice (e.g. after verify_download reset everything)
+        '''
+        write_at(self.fd, data, 0)
+        with self.lock:
+            for region in self.pending:
+                region[0] = max(region[0], len(data))
+            self.pending = [region for region in self.pending if region[0] <= region[1]]
+            if self.segments is not None:
+                # an older head is replaced, a longer segment from 0 already covers it
+                self.segments = [seg for seg in self.segments if seg[0] != 0 or seg[1] >= len(data)]
+                if not any(seg[0] == 0 for seg in self.segments):
+                    self.segments.append([0, len(data) - 1, zlib.crc32(data)])
+    
+    def finish(self, range_id, tid=None, nbytes=0, seconds=0):
+        with self.lock:
+            r = self.ranges.pop(range_id, None)
+            self.active.pop(range_id, None)
+            if r and r[0] > r[2] and self.segments is not None:
+                self.segments.append([r[2], r[0] - 1, r[3]])
+            if tid is not None and seconds > 0:
+                speed = nbytes / seconds
+                size = int(speed * RANGE_TARGET_SECONDS)
+                self.range_size[tid] = min(max(size, MIN_SPLIT_SIZE), self.chunk_size * MAX_RANGE_FACTOR)
+    
+    def has_work(self):
+        with self.lock:
+            return bool(self.pending) or bool(self.active)
+    
+    def fail(self, range_id):
+        '''keep the range in the journal, but nobody works on it anymore
+        '''
+        with self.lock:
+            self.active.pop(range_id, None)
+
+HOST_STATE_FILE = os.path.join(os.path.expanduser('~'), '.deovr-dl-hosts.json')
+TUNE_INTERVAL = 3        # seconds between throughput samples
+TUNE_GAIN = 0.05         # an extra connection must add 5% throughput to keep growing
+TUNE_HOLD = 10           # samples without growing after a connection that didn't help was taken back
+RETRY_STATUS = [403, 429, 503]  # CDN throttling, back off and retry
+
+def load_host_state(state_file=HOST_STATE_FILE):
+    '''{host: {"threads": n, "speed": bytes per second}}
+    '''
+    if state_file and os.path.exists(state_file):
+        try:
+            with open(state_file, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Bad host state file {state_file}: {e}")
+    return {}
+
+def get_remote_size(session, url):
+    '''total size from a one byte range request, -1 if unknown
+    '''
+    response = download_chunk_helper(session, url, 0, 0, stream=False)  # body read, connection goes back to the pool
+    content_range = response.headers.get('Content-Range', '')
+    if response.status_code != 206 or '/' not in content_range:
+        return -1
+    return int(content_range.split('/')[-1])
+
+class ConcurrencyController:
+    '''AIMD connection count for one CDN host
+
+    One more connection every sample while aggregate throughput keeps rising,
+    one less when the last one added didn't help (then hold a while before
+    trying again), half the connections after a throttling response or error.
+    The best connection count seen is remembered per host in the state file.
+    '''
+    def __init__(self, host, initial=4, max_limit=16, state_file=HOST_STATE_FILE):
+        self.host = host
+        self.max_limit = max_limit
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.errors = 0
+        self.last_bytes = 0
+        self.last_time = time.time()
+        self.last_speed = 0
+        self.best_speed = 0
+        self.grew = False  # last sample added a connection
+        self.hold = 0      # samples left before growing again
         
-        while not stop_event.is_set():
-            repeat -= 1
-            try:
-                response = download_chunk_helper(session, shared_data['url'], start, end)
-                if response.status_code == 206:
-                    result_queue.put((tid, chunk_id, start, response.content))
-                else:
-                    print(f'Thread {tid} Error: HTTP response code {response.status_code}, downloading {chunk_id} {start:,}-{end:,}')
-                    result_queue.put((tid, chunk_id, -2, None))
+        state = self.load_state()
+        if host in state:
+            initial = state[host]['threads']
+            print(f"Auto tune: {host} remembered {initial} threads")
+        self.limit = min(max(initial, 1), max_limit)
+        self.best_limit = self.limit
+    
+    def load_state(self):
+        return load_host_state(self.state_file)
+    
+    def save_state(self):
+        if not self.state_file or self.best_speed == 0:
+            return
+        state = self.load_state()
+        state[self.host] = {'threads': self.best_limit, 'speed': int(self.best_speed)}
+        tmp_file = f"{self.state_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_file, self.state_file)
+    
+    def allowed(self, tid):
+        return tid < self.limit
+    
+    def report_error(self):
+        with self.lock:
+            self.errors += 1
+    
+    def sample(self, written):
+        '''called periodically with total bytes written so far
+        '''
+        now = time.time()
+        with self.lock:
+            speed = (written - self.last_bytes) / (now - self.last_time)
+            self.last_bytes, self.last_time = written, now
+            if speed > self.best_speed:
+                self.best_speed, self.best_limit = speed, self.limit
+            old_limit = self.limit
+            improved = speed > self.last_speed * (1 + TUNE_GAIN)
+            if self.errors:
+                self.limit = max(self.limit // 2, 1)
+                self.grew = False
+            elif self.grew and not improved:
+                # the extra connection didn't add throughput, take it back
+                self.limit = max(self.limit - 1, 1)
+                self.grew = False
+                self.hold = TUNE_HOLD
+            elif improved and self.hold == 0:
+                self.limit = min(self.limit + 1, self.max_limit)
+                self.grew = self.limit != old_limit
+            else:
+                self.grew = False
+                self.hold = max(self.hold - 1, 0)
+            self.errors = 0
+            self.last_speed = speed
+            if self.limit != old_limit:
+                print(f"Auto tune: {speed/1024**2:.2f} MiB/s, threads {old_limit} -> {self.limit}")
+
+def download_chunk_thread(session, tid, result_queue, shared_data, scheduler, repeat=1, controller=None):
+    scheduler.range_size.setdefault(tid, scheduler.chunk_size)
+    while not stop_event.is_set():
+        if controller and not controller.allowed(tid):
+            # parked by the controller, wait until allowed again or work is done
+            if not scheduler.has_work():
                 break
-            except Exception as e:
-                print(f'Thread {tid} Exception {e}, downloading {chunk_id}, repeat {repeat}')
-                if repeat<= 0:
-                    result_queue.put((tid, chunk_id, -2, None))
-                    break
+            time.sleep(0.5)
+            continue
+        if not acquire_connection():
+            break
+        task = scheduler.next_range(tid)
+        if task is None:
+            release_connection()
+            break
+        try:
+            download_range(session, tid, result_queue, shared_data, scheduler, task, repeat, controller)
+        finally:
+            release_connection()
         
-    result_queue.put((tid, -1, -1, None))
+    result_queue.put((tid, -1, -1, 0))
     print(f'Thread {tid} finished')
 
-def download_file_in_chunks(session, url, start_offset=64, chunk_size=100 * 1024 * 1024, output_file='output.mp4', recover_file="", max_threads=4, repeat=1):
-    '''donwload file multi thread
+def download_range(session, tid, result_queue, shared_data, scheduler, task, repeat, controller):
+    '''download one range of the scheduler, retry from the last written byte
     '''
+    fd = shared_data['fd']
+    range_id, start, end = task
+    print(f"{f'Thread {tid}: Downloading range':<30s} {range_id:3d} {start:,}-{end:,}")
+
     tic = time.time()
-    recover_mode = False
-    task_finished = []
+    pos = start
+    crc = 0
+    repeat_t = repeat
+    while not stop_event.is_set():
+        repeat_t -= 1
+        try:
+            # retry continues from the last written byte, not the range start
+            end = scheduler.end_of(range_id)
+            response = download_chunk_helper(session, shared_data['url'], pos, end)
+            if response.status_code == 206:
+                check_range_response(response.headers, pos, end, scheduler.total_size, scheduler.etag)
+                # write data to its offset as it arrives, never hold the whole range
+                for data in response.iter_content(chunk_size=rate_limiter.block_size(STREAM_BLOCK_SIZE)):
+                    if stop_event.is_set():
+                        break
+                    rate_limiter.consume(len(data))
+                    end = scheduler.end_of(range_id)
+                    data = data[:end - pos + 1]  # tail may have been stolen
+                    write_at(fd, data, pos)
+                    crc = zlib.crc32(data, crc)
+                    pos += len(data)
+                    end = scheduler.update(range_id, pos, crc)
+                    if pos > end:
+                        break
+                response.close()
+                if stop_event.is_set():
+                    break
+                end = scheduler.end_of(range_id)
+                if pos <= end:
+                    raise Exception(f"incomplete range, got {pos - start:,}/{end - start + 1:,} bytes")
+                scheduler.finish(range_id, tid, pos - start, time.time() - tic)
+                result_queue.put((tid, range_id, start, pos - start))
+            elif response.status_code in RETRY_STATUS and repeat_t > 0:
+                response.close()
+                if controller:
+                    controller.report_error()
+                retry_after = response.headers.get('Retry-After', '')
+                wait = int(retry_after) if retry_after.isdigit() else 2
+                print(f'Thread {tid} HTTP response code {response.status_code}, downloading {range_id}, retry after {wait}s, repeat {repeat_t}')
+                time.sleep(min(wait, 60))
+                continue
+            else:
+                print(f'Thread {tid} Error: HTTP response code {response.status_code}, downloading {range_id} {pos:,}-{end:,}')
+                scheduler.fail(range_id)
+                result_queue.put((tid, range_id, -2, pos - start))
+            break
+        except RemoteChanged as e:
+            print(f'Thread {tid} Error: {e}, downloading {range_id}')
+            scheduler.fail(range_id)
+            result_queue.put((tid, range_id, -2, pos - start))
+            break
+        except Exception as e:
+            print(f'Thread {tid} Exception {e}, downloading {range_id}, repeat {repeat_t}')
+            if controller:
+                controller.report_error()
+            if repeat_t <= 0:
+                scheduler.fail(range_id)
+                result_queue.put((tid, range_id, -2, pos - start))
+                break
+
+def read_recover_file(recover_file):
     if recover_file and os.path.exists(recover_file):
-        with open(recover_file, 'r') as f:
-            task_finished = json.load(f)
-            recover_mode = True
+        try:
+            with open(recover_file, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            print(f"Bad recover file {recover_file}: {e}")
+    return None
+
+def fallocate(fd, length):
+    '''reserve blocks 0..length, OSError(EOPNOTSUPP) when the filesystem can't
+
+    On Linux this calls the fallocate syscall directly: glibc's posix_fallocate
+    emulates it on filesystems without support by writing every block, which
+    can stall a multi-GB download for minutes before its first byte.
+    '''
+    if sys.platform.startswith('linux'):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            func = getattr(libc, 'fallocate64', None) or libc.fallocate
+        except (OSError, AttributeError):
+            raise OSError(errno.EOPNOTSUPP, "fallocate not available")
+        func.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        if func(fd, 0, 0, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    elif hasattr(os, 'posix_fallocate'):
+        os.posix_fallocate(fd, 0, length)  # native on the BSDs, EOPNOTSUPP instead of emulation
+    else:
+        raise OSError(errno.EOPNOTSUPP, "fallocate not available")
+
+def allocate_file(fd, output_file, total_size, preallocate=True, check_space=False):
+    '''size the output file before threads write into it by offset
+
+    preallocate reserves all blocks up front (fallocate), so ranges written out
+    of order by many threads don't leave the file fragmented. It is only done
+    where the filesystem supports it natively, otherwise (or without it) the
+    file is only extended (sparse).
+    '''
+    if check_space:
+        allocated = os.fstat(fd).st_blocks * 512 if hasattr(os.stat_result, 'st_blocks') else os.fstat(fd).st_size
+        free = shutil.disk_usage(os.path.dirname(os.path.abspath(output_file))).free
+        if free < total_size - allocated:
+            print(f"Not enough disk space, need {total_size - allocated:,} bytes, free {free:,} bytes")
+            return False
+    if preallocate:
+        try:
+            fallocate(fd, total_size)
+            return True
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                print(f"Not enough disk space for {total_size:,} bytes")
+                return False
+            # EOPNOTSUPP: not supported by the filesystem, fall back to a sparse file
+    os.ftruncate(fd, total_size)
+    return True
+
+def prepare_scheduler(fd, recover_file, recover_data, total_size, start_offset, chunk_size, etag=''):
+    '''fill a scheduler with the ranges still needed
+    '''
+    ranges = segments = None
+    if recover_data is not None:
+        ranges, segments = load_recover_ranges(recover_data, total_size, etag, start_offset, chunk_size)
+        if ranges is None:
+            print("Recover file doesn't match remote file, download from start")
+            os.ftruncate(fd, 0)
+    recover_mode = ranges is not None
+    if not recover_mode:
+        ranges = [(start_offset, total_size - 1)] if start_offset < total_size else []
     
-    out_file = open(output_file, 'wb' if not recover_mode else 'r+b')
+    scheduler = RangeScheduler(recover_file, fd, total_size, chunk_size, etag)
+    for start, end in ranges:
+        scheduler.add_region(start, end)
+    if recover_mode:
+        scheduler.segments = segments
+    
+    if recover_mode:
+        remain = scheduler.remain_bytes() / total_size
+        print(f"Recovered {1 - remain:.2f}, remain {remain:.2f}")
+    return scheduler
+
+def verify_download(scheduler, checksum):
+    '''whole file crc32 from the range crc32s computed while streaming, no second read
+
+    fill checksum dict with crc32, size and etag. On failure the scheduler is
+    reset so the saved recover file downloads the whole file again
+    '''
+    if scheduler.segments is None:
+        print("Resumed from old recover file, no checksum")
+        return True
+    crc = scheduler.file_crc32()
+    if crc is None or os.fstat(scheduler.fd).st_size != scheduler.total_size:
+        print("Verify failed, download again")
+        with scheduler.lock:
+            scheduler.segments, scheduler.ranges, scheduler.pending = [], {}, [[0, scheduler.total_size - 1]]
+        return False
+    print(f"CRC32: {crc:08x}")
+    if checksum is not None:
+        checksum.update({'crc32': f"{crc:08x}", 'size': scheduler.total_size, 'etag': scheduler.etag})
+    return True
+
+def print_download_bytes(tic, download_bytes):
+    toc = time.time()
+    speed = download_bytes / (toc - tic)
+    print(f"Download bytes: {download_bytes:,}|{download_bytes/1024**2:.2f} MiB")
+    print(f"Elapsed time: {seconds_to_hms(int(toc - tic))} Speed: {speed/1024**2:.2f} MiB/s")
+
+def download_file_in_chunks(session, url, start_offset=64, chunk_size=100 * 1024 * 1024, output_file='output.mp4', recover_file="", max_threads=4, repeat=1, journal_interval=5,
+                            auto_threads=False, max_auto_threads=16, state_file=HOST_STATE_FILE, preallocate=True, check_space=False, checksum=None):
+    '''donwload file multi thread
+
+    auto_threads: tune the connection count while downloading, max_threads is
+    the start value for a host not seen before
+    check_space: fail before downloading when the disk can't hold the file
+    checksum: dict, filled with crc32/size/etag of the downloaded file
+    '''
+    tic = time.time()
+    recover_data = read_recover_file(recover_file)
+    fd = open_output_fd(output_file, truncate=recover_data is None)
     # get total size
     repeat_t = repeat
     while True:
         repeat_t -= 1
         try:
-            response = download_chunk_helper(session, url, 0, start_offset-1)
+            response = download_chunk_helper(session, url, 0, start_offset-1, stream=False)
             break
         except Exception as e:
             if repeat_t <= 0:
-                print(f"Get total size failed")
+                print("Get total size failed")
                 print(f"Exception {e}, repeat {repeat}")
+                os.close(fd)
                 return False
     total_size = int(response.headers.get('Content-Range').split('/')[-1])
-    out_file.write(response.content)
-    
-    lock = threading.Lock()
-    task_queue = queue.Queue()
-    chunk_id = 0
-    for start in range(start_offset, total_size, chunk_size):
-        end = min(start + chunk_size - 1, total_size - 1)
-        if chunk_id not in task_finished:  # not downloaded
-            task_queue.put((chunk_id, start, end))
-        chunk_id += 1
-    chunk_num = chunk_id
-    
-    if recover_mode:
-        remain = task_queue.qsize()/chunk_num
-        print(f"Recovered {1 - remain:.2f}, remain {remain:.2f}")
+    etag = response.headers.get('ETag', '')
+    scheduler = prepare_scheduler(fd, recover_file, recover_data, total_size, start_offset, chunk_size, etag)
+    if not allocate_file(fd, output_file, total_size, preallocate, check_space):
+        os.close(fd)
+        return False
+    scheduler.write_head(response.content)
 
     shared_data = {
         'url': url,
-        'chunk_num': chunk_num,
+        'fd': fd,
     }
     
+    controller = None
+    if auto_threads:
+        host = urllib.parse.urlsplit(url).hostname
+        controller = ConcurrencyController(host, max_threads, max_auto_threads, state_file)
+        max_threads = controller.max_limit
+    
     result_queue = queue.Queue()
     threads = []
     for i in range(max_threads):
-        t = threading.Thread(target=download_chunk_thread, args=(session, i, result_queue, shared_data, lock, task_queue, repeat))
+        t = threading.Thread(target=download_chunk_thread, args=(session, i, result_queue, shared_data, scheduler, repeat, controller))
         t.start()
         threads.append(t)
     
     success = True
     count_finished = 0
     download_bytes = 0
+    last_save = last_tune = time.time()
     try:
         while True:
-            tid, chunk_id, start, chunk = result_queue.get()
+            try:
+                _, chunk_id, start, nbytes = result_queue.get(timeout=1)
+            except queue.Empty:
+                chunk_id, start, nbytes = None, None, 0
+            if time.time() - last_save >= journal_interval:
+                scheduler.save()
+                last_save = time.time()
+            if controller and time.time() - last_tune >= TUNE_INTERVAL:
+                controller.sample(scheduler.written)
+                last_tune = time.time()
+            if start is None:
+                continue
             if start == -1:  # download finished
                 count_finished += 1
                 if count_finished == max_threads:
@@ -157,37 +909,35 @@ def download_file_in_chunks(session, url, start_offset=64, chunk_size=100 * 1024
                 continue
             elif start == -2:  # download error
                 success = False
+                download_bytes += nbytes
                 continue
-            print(f'{"         Downloaded chunk":<30s} {chunk_id:3d}')
-            out_file.seek(start)
-            out_file.write(chunk)
-            download_bytes += len(chunk)
-            task_finished.append(chunk_id)
+            print(f'{"         Downloaded range":<30s} {chunk_id:3d}')
+            download_bytes += nbytes
     except KeyboardInterrupt:
         print("KeyboardInterrupt, saving recover file")
-        print(task_finished)
-        task_finished.sort()
-        with open(recover_file, 'w') as f:
-            json.dump(task_finished, f, indent=4)
-        
-        out_file.close()
         
         stop_event.set()
         for t in threads:
             t.join()
+        scheduler.save()
+        os.close(fd)
+        if controller:
+            controller.save_state()
+        print(f"Remain {scheduler.remain_bytes():,} bytes")
         print("All threads stopped, exit")
         exit(0)
     
-    out_file.close()
+    if stop_event.is_set():  # stopped from another thread, keep the recover file
+        success = False
+    if success and not verify_download(scheduler, checksum):
+        success = False
     if not success:
-        with open(recover_file, 'w') as f:
-            json.dump(task_finished, f, indent=4)
+        scheduler.save()
     else:
-        if os.path.exists(recover_file):
-            os.remove(recover_file)
+        scheduler.remove()
+    os.close(fd)
+    if controller:
+        controller.save_state()
     
-    toc = time.time()
-    speed = download_bytes / (toc - tic)
-    print(f"Download bytes: {download_bytes:,}|{download_bytes/1024**2:.2f} MiB")
-    print(f"Elapsed time: {seconds_to_hms(int(toc - tic))} Speed: {speed/1024**2:.2f} MiB/s")
+    print_download_bytes(tic, download_bytes)
     return success
@@ -0,0 +1,559 @@
+'''library index, top.json is generated from it
+
+top.json used to be parsed and rewritten with indent=4 for every title added
+or removed. The index lives in <root_dir>/library.db (sqlite) now, every
+change is one small sqlite write and top.json is materialized only when
+something changed, once per batch:
+
+    library = Library(root_dir)
+    with library.batch():
+        for ...:
+            library.add_title(playlist, video_json)
+    # top.json written here, once
+
+top.json stays the file DeoVR reads. When it is edited by hand it is
+imported again on the next batch.
+
+Lookups are served from an in memory index {playlist: {title: short json}},
+kept in step with every change and reloaded only when another process wrote
+to library.db, so moving or checking thousands of titles is O(1) per title.
+
+Bulk changes that touch files (move, dupdel, check) are planned first and run
+by apply(): the plan is saved to batch-journal.json, files are moved/deleted,
+then all index changes are committed in one transaction. An interrupted batch
+is rolled forward the next time the library is opened. batch-journal.lock is
+held meanwhile, so processes run their batches one after another and never
+roll forward a batch that is still running.
+
+With a deeplink page size set, deeplink/ holds the same index split by
+playlist and page in compact json, only changed playlists are written again.
+'''
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import urllib.parse
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # windows, batches are not locked between processes
+
+LIBRARY_DB = 'library.db'
+TITLE_SORT_KEYS = {
+    'date': None,  # order added
+    'title': lambda v: v['title'].lower(),
+    'duration': lambda v: v['vidoeLength'] or 0,
+}
+BATCH_JOURNAL = 'batch-journal.json'
+BATCH_LOCK = 'batch-journal.lock'  # held while a batch runs, kept so every process locks the same file
+DEEPLINK_DIR = 'deeplink'  # split deeplink: deeplink/index.json, deeplink/<playlist>/<page>.json
+DEEPLINK_PAGE_SIZE = 500
+DEFAULT_CURRENT_ID = 1000
+FILE_OP_KEYS = ['src', 'dst', 'path']  # batch op fields holding a file path
+
+def make_short_video_json(video_json):
+    '''title entry of top.json
+    '''
+    return {
+        'title': video_json['title'],
+        'vidoeLength': video_json['videoLength'],
+        'video_url': video_json['video_url'],
+        'thumbnail_url': video_json['thumbnailUrl'],
+    }
+
+def file_stat(path):
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+@contextmanager
+def file_lock(path, blocking=True):
+    '''exclusive lock between processes, yields False when not blocking and another process holds it.
+    Released by the OS when the holder dies, so a crashed batch never blocks the next one
+    '''
+    with open(path, 'a') as f:
+        if fcntl is None:
+            yield True
+            return
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def write_file_atomic(path, text):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+class Library:
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)  # the tool may be run again from another dir, see apply
+        self.top_json_path = os.path.join(self.root_dir, 'top.json')
+        # autocommit, every change is persisted at once so a crash never loses titles
+        self.conn = sqlite3.connect(os.path.join(self.root_dir, LIBRARY_DB), check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.depth = 0       # nested batch() count
+        self.dirty = False   # top.json out of date
+        self.dirty_playlists = set()  # playlists changed since the split deeplink was written, None for all
+        self.index = None    # {playlist: {title: short video json}}, same order as top.json
+        self.data_version = None
+        self.generation = 0  # increased on every index change, see version()
+        self.sort_cache = {}  # {(playlist, sort): [title]}, for generation sort_generation
+        self.sort_generation = None
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.executescript('''
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS scenes (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL);
+                CREATE TABLE IF NOT EXISTS titles (id INTEGER PRIMARY KEY AUTOINCREMENT, playlist TEXT NOT NULL, title TEXT NOT NULL,
+                                                   json TEXT NOT NULL, UNIQUE (playlist, title));
+                CREATE TABLE IF NOT EXISTS probes (dev INTEGER, ino INTEGER, size INTEGER, mtime_ns INTEGER, meta TEXT NOT NULL,
+                                                   PRIMARY KEY (dev, ino));
+                CREATE TABLE IF NOT EXISTS snapshots (playlist TEXT, name TEXT, size INTEGER, mtime_ns INTEGER, PRIMARY KEY (playlist, name));
+            ''')
+            self.dirty = self.get_meta('dirty') == '1'  # last process stopped before writing top.json
+            if self.dirty:
+                self.dirty_playlists = None
+            self.sync()
+            self.get_index()
+            self.roll_forward()
+
+    def get_meta(self, key, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def sync(self):
+        '''import top.json when it was changed outside the library
+        '''
+        stat = file_stat(self.top_json_path)
+        if stat == self.get_meta('top_json_stat') or self.dirty:
+            return
+        if stat is None:
+            self.mark_dirty()  # top.json deleted, write it again
+        else:
+            print("top.json changed, import to library index")
+            with open(self.top_json_path, 'r') as f:
+                db_json = json.load(f)
+            self.replace(db_json or {})
+            self.set_meta('top_json_stat', stat)
+            self.set_meta('dirty', 0)
+            self.dirty = False
+
+    def get_index(self):
+        '''resident index, loaded again only when another connection changed the db
+        '''
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if self.index is None or data_version != self.data_version:
+            index = {}
+            for (name,) in self.conn.execute("SELECT name FROM scenes ORDER BY id"):
+                index[name] = {}
+            for playlist, title, short_json in self.conn.execute("SELECT playlist, title, json FROM titles ORDER BY id"):
+                if playlist in index:
+                    index[playlist][title] = json.loads(short_json)
+            self.index = index
+            self.data_version = data_version
+            self.generation += 1
+        return self.index
+
+    def version(self):
+        '''changes whenever the index changes, in this process or another one, or top.json was edited.
+        For caches of anything rendered from the index
+        '''
+        with self.lock:
+            if self.depth == 0:
+                self.sync()
+            self.get_index()
+            return self.generation
+
+    def mark_dirty(self, *playlists):
+        '''playlists: the playlists changed, for the split deeplink
+        '''
+        self.generation += 1
+        if self.dirty_playlists is not None:
+            self.dirty_playlists.update(playlists)
+        if not self.dirty:
+            self.set_meta('dirty', 1)
+            self.dirty = True
+
+    @contextmanager
+    def batch(self):
+        '''group changes, top.json is written once when the outermost batch ends
+        '''
+        with self.lock:
+            if self.depth == 0:
+                self.sync()
+            self.depth += 1
+            try:
+                yield self
+            finally:
+                self.depth -= 1
+                if self.depth == 0 and (self.dirty or self.dirty_playlists != set()):
+                    self.materialize()
+
+    @contextmanager
+    def transaction(self):
+        '''all changes in the block are committed together, or none
+        '''
+        with self.batch():
+            self.conn.execute("BEGIN")
+            try:
+                yield self
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                self.index = None
+                self.dirty = self.get_meta('dirty') == '1'
+                self.dirty_playlists = None
+                raise
+
+    def apply(self, ops):
+        '''run a planned batch, see run_ops for the operations
+
+        the plan is journaled first, so an interrupted batch can be rolled forward.
+        Batches of other processes wait for the lock, one journal at a time
+        '''
+        if not ops:
+            return
+        # file paths relative to root_dir, roll forward works from any cwd
+        ops = [{key: os.path.relpath(value, self.root_dir) if key in FILE_OP_KEYS else value for key, value in op.items()} for op in ops]
+        journal_path = os.path.join(self.root_dir, BATCH_JOURNAL)
+        with self.lock, file_lock(os.path.join(self.root_dir, BATCH_LOCK)):
+            self.run_journal()  # left by a process that died while this one waited for the lock
+            tmp_path = f"{journal_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(ops, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, journal_path)
+            self.run_ops(ops)
+            os.remove(journal_path)
+
+    def roll_forward(self):
+        journal_path = os.path.join(self.root_dir, BATCH_JOURNAL)
+        if not os.path.exists(journal_path):
+            return
+        with file_lock(os.path.join(self.root_dir, BATCH_LOCK), blocking=False) as locked:
+            # a locked journal is not interrupted, another process is still running it
+            if locked:
+                self.run_journal()
+
+    def run_journal(self):
+        '''run the batch of an interrupted apply, called with the batch lock held
+        '''
+        journal_path = os.path.join(self.root_dir, BATCH_JOURNAL)
+        if not os.path.exists(journal_path):
+            return
+        with open(journal_path, 'r') as f:
+            ops = json.load(f)
+        print(f"Interrupted batch found, roll forward {len(ops)} operations")
+        self.run_ops(ops)
+        os.remove(journal_path)
+
+    def run_ops(self, ops):
+        '''every operation can run again after a crash and gives the same result
+
+        files:  {"op": "move", "src": path, "dst": path}, {"op": "delete", "path": path},
+                {"op": "write", "path": path, "text": str}
+        index:  {"op": "add_title", "playlist": p, "video_json": {...}}, {"op": "del_title", "playlist": p, "title": t},
+                {"op": "del_playlist", "playlist": p}
+        '''
+        ops = [{key: os.path.join(self.root_dir, value) if key in FILE_OP_KEYS else value for key, value in op.items()} for op in ops]
+        for op in ops:
+            if op['op'] == 'move':
+                if os.path.lexists(op['src']):  # gone when already moved
+                    os.makedirs(os.path.dirname(op['dst']), exist_ok=True)
+                    shutil.move(op['src'], op['dst'])
+            elif op['op'] == 'delete':
+                if os.path.isdir(op['path']):
+                    shutil.rmtree(op['path'])
+                elif os.path.lexists(op['path']):
+                    os.remove(op['path'])
+            elif op['op'] == 'write':
+                write_file_atomic(op['path'], op['text'])
+        with self.transaction():
+            for op in ops:
+                if op['op'] == 'add_title':
+                    self.add_title(op['playlist'], op['video_json'])
+                elif op['op'] == 'del_title':
+                    self.del_title(op['playlist'], op['title'])
+                elif op['op'] == 'del_playlist':
+                    self.del_playlist(op['playlist'])
+
+    def materialize(self):
+        '''write top.json from the index, atomic rename so readers never see half a file
+        '''
+        with self.lock:
+            if self.dirty:
+                db_json = self.to_db_json()
+                write_file_atomic(self.top_json_path, json.dumps(db_json, indent=4, ensure_ascii=False))
+                self.set_meta('top_json_stat', file_stat(self.top_json_path))
+                self.set_meta('dirty', 0)
+                self.dirty = False
+            if self.get_deeplink_page_size():
+                self.write_split_deeplink(self.dirty_playlists)
+            self.dirty_playlists = set()
+
+    # split deeplink: a small root document and compact per-playlist pages, instead of one big top.json
+    def get_deeplink_page_size(self):
+        '''titles per page of the split deeplink, 0 when only top.json is written
+        '''
+        return int(self.get_meta('deeplink_page_size', 0))
+
+    def set_deeplink_page_size(self, page_size, server=''):
+        '''server: address hosting root_dir, the page urls are built from it like the video urls
+        '''
+        with self.batch():
+            self.set_meta('deeplink_page_size', page_size)
+            self.set_meta('deeplink_server', server.rstrip('/'))
+            self.dirty_playlists = None
+        if not page_size:
+            shutil.rmtree(os.path.join(self.root_dir, DEEPLINK_DIR), ignore_errors=True)
+
+    def change_server(self, old_server, new_server):
+        '''move all urls of the index and the split deeplink to new_server, top.json follows at the end of the batch
+        '''
+        old_server, new_server = old_server.rstrip('/'), new_server.rstrip('/')
+        with self.batch():
+            text = json.dumps(self.to_db_json(), ensure_ascii=False)
+            self.replace(json.loads(text.replace(old_server, new_server)))
+            self.set_meta('deeplink_server', self.get_meta('deeplink_server', '').replace(old_server, new_server))
+            self.mark_dirty()
+
+    def write_split_deeplink(self, playlists=None):
+        '''deeplink/<playlist>/<page>.json: a deeplink with one scene, one page of the playlist
+        deeplink/index.json: a deeplink with one scene per playlist holding its first page,
+        "pages" lists the absolute urls of all its page deeplinks:
+            {"scenes": [{"name": playlist, "list": [short video json], "total": n, "pages": ["{server}/deeplink/<playlist>/1.json", ...]}]}
+
+        playlists: only write the pages of these playlists, None for all. index.json is always written
+        '''
+        with self.lock:
+            page_size = self.get_deeplink_page_size()
+            server = self.get_meta('deeplink_server', '')
+            deeplink_dir = os.path.join(self.root_dir, DEEPLINK_DIR)
+            index = self.get_index()
+            root_path = os.path.join(deeplink_dir, 'index.json')
+            if playlists is None or not os.path.exists(root_path):
+                playlists = set(index)
+                if os.path.isdir(deeplink_dir):
+                    playlists.update(name for name in os.listdir(deeplink_dir) if os.path.isdir(os.path.join(deeplink_dir, name)))
+            
+            scenes = []
+            for name, titles in index.items():
+                pages = (len(titles) + page_size - 1) // page_size
+                scenes.append({'name': name, 'list': list(titles.values())[:page_size], 'total': len(titles),
+                               'pages': [f"{server}/{urllib.parse.quote(f'{DEEPLINK_DIR}/{name}/{page}.json')}" for page in range(1, pages + 1)]})
+            for name in playlists:
+                playlist_dir = os.path.join(deeplink_dir, name)
+                if name not in index:
+                    shutil.rmtree(playlist_dir, ignore_errors=True)
+                    continue
+                os.makedirs(playlist_dir, exist_ok=True)
+                titles = list(index[name].values())
+                pages = (len(titles) + page_size - 1) // page_size
+                for page in range(pages):
+                    page_json = {'scenes': [{'name': name if pages == 1 else f"{name} {page + 1}/{pages}",
+                                             'list': titles[page * page_size:(page + 1) * page_size]}]}
+                    write_file_atomic(os.path.join(playlist_dir, f"{page + 1}.json"), json.dumps(page_json, separators=(',', ':'), ensure_ascii=False))
+                # pages left from a bigger playlist
+                for file in os.listdir(playlist_dir):
+                    number = os.path.splitext(file)[0]
+                    if not number.isdigit() or int(number) > pages:
+                        os.remove(os.path.join(playlist_dir, file))
+            write_file_atomic(root_path, json.dumps({'scenes': scenes, 'current_id': self.get_current_id()}, separators=(',', ':'), ensure_ascii=False))
+
+    def replace(self, db_json):
+        '''replace the whole index with a top.json dict
+        '''
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM scenes")
+                self.conn.execute("DELETE FROM titles")
+                for scene in db_json.get('scenes', []):
+                    self.conn.execute("INSERT OR IGNORE INTO scenes (name) VALUES (?)", (scene['name'],))
+                    self.conn.executemany("INSERT OR IGNORE INTO titles (playlist, title, json) VALUES (?, ?, ?)",
+                                          [(scene['name'], v['title'], json.dumps(v, ensure_ascii=False)) for v in scene['list']])
+                self.set_meta('current_id', db_json.get('current_id', DEFAULT_CURRENT_ID))
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            finally:
+                self.index = None
+            self.dirty_playlists = None  # any playlist may have changed, write all deeplink pages
+
+    def to_db_json(self):
+        '''top.json dict: {"scenes": [{"name": playlist, "list": [short video json]}], "current_id": n}
+        '''
+        with self.lock:
+            # copies, the dict may be changed by the caller
+            scenes = [{'name': name, 'list': [dict(v) for v in titles.values()]} for name, titles in self.get_index().items()]
+            return {'scenes': scenes, 'current_id': self.get_current_id()}
+
+    # ids
+    def get_current_id(self):
+        return int(self.get_meta('current_id', DEFAULT_CURRENT_ID))
+
+    def current_id_inc(self):
+        with self.batch():
+            self.set_meta('current_id', self.get_current_id() + 1)
+            self.mark_dirty()
+
+    # playlists
+    def get_playlists(self):
+        with self.lock:
+            return list(self.get_index())
+
+    def has_playlist(self, playlist):
+        with self.lock:
+            return playlist in self.get_index()
+
+    def add_playlist(self, playlist):
+        with self.batch():
+            if self.has_playlist(playlist):
+                return False
+            self.conn.execute("INSERT INTO scenes (name) VALUES (?)", (playlist,))
+            self.index[playlist] = {}
+            self.mark_dirty(playlist)
+            return True
+
+    def del_playlist(self, playlist):
+        with self.batch():
+            if not self.has_playlist(playlist):
+                return False
+            self.conn.execute("DELETE FROM titles WHERE playlist=?", (playlist,))
+            self.conn.execute("DELETE FROM scenes WHERE name=?", (playlist,))
+            del self.index[playlist]
+            self.mark_dirty(playlist)
+            return True
+
+    def rename_playlist(self, src_playlist, dst_playlist):
+        with self.batch():
+            if not self.has_playlist(src_playlist) or self.has_playlist(dst_playlist):
+                return False
+            self.conn.execute("UPDATE scenes SET name=? WHERE name=?", (dst_playlist, src_playlist))
+            self.conn.execute("UPDATE titles SET playlist=? WHERE playlist=?", (dst_playlist, src_playlist))
+            # keep the playlist at its position
+            self.index = {dst_playlist if name == src_playlist else name: titles for name, titles in self.index.items()}
+            self.mark_dirty(src_playlist, dst_playlist)
+            return True
+
+    # titles
+    def get_titles(self, playlist):
+        '''{title: short video json} in playlist order
+        '''
+        with self.lock:
+            return dict(self.get_index().get(playlist, {}))
+
+    def get_titles_page(self, playlist, offset=0, limit=60, sort='date', reverse=False):
+        '''(number of titles, [short video json]) of one page, sort: see TITLE_SORT_KEYS
+
+        the sorted order is kept until the index changes, a page costs O(limit)
+        '''
+        with self.lock:
+            titles = self.get_index().get(playlist, {})
+            if self.sort_generation != self.generation:
+                self.sort_cache = {}
+                self.sort_generation = self.generation
+            key = (playlist, sort)
+            if key not in self.sort_cache:
+                sort_key = TITLE_SORT_KEYS[sort]
+                self.sort_cache[key] = list(titles) if sort_key is None else sorted(titles, key=lambda t: sort_key(titles[t]))
+            order = self.sort_cache[key]
+            if reverse:
+                start = max(len(order) - offset - limit, 0)
+                page = order[start:max(len(order) - offset, 0)][::-1]
+            else:
+                page = order[offset:offset + limit]
+            return len(order), [dict(titles[t]) for t in page]
+
+    def has_title(self, playlist, title):
+        with self.lock:
+            return title in self.get_index().get(playlist, {})
+
+    def add_title(self, playlist, video_json):
+        '''same as db_add_title, current_id is increased for a new title
+        '''
+        with self.batch():
+            if self.has_title(playlist, video_json['title']):
+                return False
+            self.add_playlist(playlist)
+            short_video_json = make_short_video_json(video_json)
+            self.conn.execute("INSERT INTO titles (playlist, title, json) VALUES (?, ?, ?)",
+                              (playlist, video_json['title'], json.dumps(short_video_json, ensure_ascii=False)))
+            self.index[playlist][video_json['title']] = short_video_json
+            self.mark_dirty(playlist)
+            self.current_id_inc()
+            return True
+
+    def del_title(self, playlist, title):
+        with self.batch():
+            if not self.has_title(playlist, title):
+                return False
+            self.conn.execute("DELETE FROM titles WHERE playlist=? AND title=?", (playlist, title))
+            del self.index[playlist][title]
+            self.mark_dirty(playlist)
+            return True
+
+    # ffprobe results, keyed by file identity: survive renames, miss when the content changed
+    def get_probe(self, path):
+        '''cached ffmpeg_probe result, None when not probed or the file changed since
+        '''
+        st = os.stat(path)
+        with self.lock:
+            row = self.conn.execute("SELECT meta FROM probes WHERE dev=? AND ino=? AND size=? AND mtime_ns=?",
+                                    (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_probe(self, path, meta_data):
+        st = os.stat(path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO probes (dev, ino, size, mtime_ns, meta) VALUES (?, ?, ?, ?, ?)",
+                              (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, json.dumps(meta_data)))
+
+    # video files seen by the last scan of a playlist, for incremental scan
+    def get_snapshot(self, playlist):
+        '''{file name: [size, mtime_ns]}
+        '''
+        with self.lock:
+            rows = self.conn.execute("SELECT name, size, mtime_ns FROM snapshots WHERE playlist=?", (playlist,))
+            return {name: [size, mtime_ns] for name, size, mtime_ns in rows}
+
+    def set_snapshot(self, playlist, entries):
+        with self.lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute("DELETE FROM snapshots WHERE playlist=?", (playlist,))
+                self.conn.executemany("INSERT INTO snapshots (playlist, name, size, mtime_ns) VALUES (?, ?, ?, ?)",
+                                      [(playlist, name, size, mtime_ns) for name, (size, mtime_ns) in entries.items()])
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+
+libraries = {}
+libraries_lock = threading.Lock()
+
+def open_library(root_dir):
+    '''one Library per root dir in a process
+    '''
+    key = os.path.abspath(root_dir)
+    with libraries_lock:
+        if key not in libraries:
+            libraries[key] = Library(root_dir)
+        return libraries[key]
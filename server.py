@@ -1,35 +1,132 @@
 import argparse
-from flask import Flask, redirect, render_template, request, url_for
+import email.utils
+import functools
+import gzip
+import hashlib
+import http.server
+import threading
+from flask import Flask, Response, abort, redirect, render_template, request, url_for
 from db_utils import *
+from library import file_stat, TITLE_SORT_KEYS
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Flask("VRhouse", template_folder='web/templates', static_folder='web/static')
+
+# rendered responses, {key: {"version": v, "etag": str, "identity": bytes, "gzip": bytes, "br": bytes}}
+# rendered again only when the library (or the video json file) changed
+response_cache = {}
+MAX_CACHE_ENTRIES = 4096
+MIN_COMPRESS_SIZE = 1024
+PAGE_SIZE = 60       # titles rendered in the playlist page, more are loaded when scrolled down
+MAX_PAGE_SIZE = 500
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    return gzip.compress(body, compresslevel=6)
+
+def cached_response(key, version, render, mimetype='text/html'):
+    '''response with ETag, 304 for If-None-Match, gzip/brotli when the client accepts it
+    '''
+    entry = response_cache.get(key)
+    if entry is None or entry['version'] != version:
+        body = render().encode('utf-8')
+        entry = {'version': version, 'etag': hashlib.sha1(body).hexdigest()[:20], 'identity': body}
+        if len(response_cache) >= MAX_CACHE_ENTRIES:
+            response_cache.clear()
+        response_cache[key] = entry
+    
+    encoding = 'identity'
+    if len(entry['identity']) >= MIN_COMPRESS_SIZE:
+        encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'], default='identity')
+    if encoding not in entry:
+        entry[encoding] = compress(entry['identity'], encoding)
+    etag = entry['etag'] if encoding == 'identity' else f"{entry['etag']}-{encoding}"
+    
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(entry[encoding], mimetype=mimetype)
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = 'no-cache'  # always revalidate, cheap with ETag
+    return response
+
 @app.route('/')
 def index():
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
+    library = open_library(root_dir)
     
-    playlist_data = {}
-    for scene_name, scene in scene_index.items():
-        playlist_data[scene_name] = len(scene['list'])
-    return render_template('index.html', playlist_data=playlist_data)
+    def render():
+        playlist_data = {}
+        for scene_name in library.get_playlists():
+            playlist_data[scene_name] = len(library.get_titles(scene_name))
+        return render_template('index.html', playlist_data=playlist_data)
+    return cached_response('index', library.version(), render)
 
 @app.route('/playlist/<playlist>')
 def playlist(playlist):
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    title_index = get_title_index(scene_index[playlist])
+    library = open_library(root_dir)
     
-    return render_template('playlist.html', title_index=title_index, playlist=playlist)
+    def render():
+        total, titles = library.get_titles_page(playlist, 0, PAGE_SIZE)
+        return render_template('playlist.html', titles=titles, total=total, page_size=PAGE_SIZE, sort_keys=list(TITLE_SORT_KEYS), playlist=playlist)
+    return cached_response(('playlist', playlist), library.version(), render)
 
 @app.route('/video/<playlist>/<title>')
 def video(playlist, title):
-    video = read_video_json(root_dir, playlist, title)
+    library = open_library(root_dir)
+    json_path = os.path.join(root_dir, playlist, 'metadata', 'json', f"{title}.json")
+    
+    def render():
+        return render_template('video.html', video=read_video_json(root_dir, playlist, title), playlist=playlist, playlists=library.get_playlists())
+    return cached_response(('video', playlist, title), (library.version(), file_stat(json_path)), render)
+
+# DeoVR deeplink, same as the top.json file, from memory
+@app.route('/top.json')
+@app.route('/deovr')
+def top_json():
+    library = open_library(root_dir)
+    
+    def render():
+        return json.dumps(library.to_db_json(), indent=4, ensure_ascii=False)
+    return cached_response('top.json', library.version(), render, mimetype='application/json')
+
+@app.route('/<playlist>/metadata/json/<title>.json')
+def video_json(playlist, title):
+    json_path = os.path.join(root_dir, playlist, 'metadata', 'json', f"{title}.json")
+    stat = file_stat(json_path)
+    if stat is None:
+        abort(404)
     
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    return render_template('video.html', video=video, playlist=playlist, playlists=list(scene_index.keys()))
+    def render():
+        with open(json_path, 'r') as f:
+            return f.read()
+    return cached_response(('json', playlist, title), stat, render, mimetype='application/json')
 
 # Ajax
+@app.route('/api/titles/<playlist>')
+def titles(playlist):
+    '''one page of a playlist: ?offset=0&limit=60&sort=date|title|duration&order=asc|desc
+    '''
+    offset = request.args.get('offset', 0, type=int)
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    sort = request.args.get('sort', 'date')
+    order = request.args.get('order', 'asc')
+    if sort not in TITLE_SORT_KEYS or order not in ['asc', 'desc'] or offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    library = open_library(root_dir)
+    
+    def render():
+        total, titles = library.get_titles_page(playlist, offset, limit, sort, reverse=order == 'desc')
+        return json.dumps({'total': total, 'offset': offset, 'titles': titles}, ensure_ascii=False)
+    return cached_response(('titles', playlist, offset, limit, sort, order), library.version(), render, mimetype='application/json')
+
 @app.route('/api/delete/<playlist>/<title>')
 def delete(playlist, title):
     print(f"delete {playlist}/{title}")
@@ -47,16 +144,149 @@ def move():
 def rename(src_playlist, dst_playlist):
     return rename_playlist(root_dir, src_playlist, dst_playlist)
 
+# static file server for hosting mode, serves root_dir like nginx would
+class StaticHandler(http.server.SimpleHTTPRequestHandler):
+    '''GET/HEAD with Range, ETag/Last-Modified revalidation and sendfile, no directory listing
+    '''
+    protocol_version = 'HTTP/1.1'  # keep-alive, players open many range requests
+    timeout = 60
+    extensions_map = {
+        **http.server.SimpleHTTPRequestHandler.extensions_map,
+        '.mp4': 'video/mp4',
+        '.mkv': 'video/x-matroska',
+        '.json': 'application/json',
+        '.m3u8': 'application/vnd.apple.mpegurl',
+        '.mpd': 'application/dash+xml',
+        '.m4s': 'video/iso.segment',
+        '.ts': 'video/mp2t',
+    }
+    revalidate_types = ['application/json', 'text/html']  # change in place, media files don't
+    
+    def guess_type(self, path):
+        if os.path.basename(path) == 'deovr':  # link to top.json
+            return 'application/json'
+        return super().guess_type(path)
+    
+    def send_head(self):
+        '''send the headers, return (file, offset, length) for the body, or None
+        '''
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return None
+        f = open(path, 'rb')
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+        ctype = self.guess_type(path)
+        
+        if self.headers.get('If-None-Match', '') == etag or \
+           ('If-None-Match' not in self.headers and self.headers.get('If-Modified-Since') == last_modified):
+            f.close()
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+        
+        start, length, byte_range = 0, size, None
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', etag) in [etag, last_modified]:
+            byte_range = parse_range(range_header, size)
+            if byte_range is False:
+                f.close()
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{size}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return None
+            if byte_range is not None:
+                start, end = byte_range
+                length = end - start + 1
+        
+        if byte_range is None:
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{start + length - 1}/{size}')
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Cache-Control', 'no-cache' if ctype in self.revalidate_types else 'public, max-age=86400')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+        return f, start, length
+    
+    def do_GET(self):
+        head = self.send_head()
+        if head:
+            f, start, length = head
+            try:
+                self.wfile.flush()
+                self.connection.sendfile(f, start, length)  # os.sendfile, the data never passes through python
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True  # player seeked and dropped the connection
+            finally:
+                f.close()
+    
+    def do_HEAD(self):
+        head = self.send_head()
+        if head:
+            head[0].close()
+
+def parse_range(range_header, size):
+    '''(start, end) of a single "bytes=" range, None to send the whole file, False when not satisfiable
+
+    an invalid spec (e.g. bytes=100-50) is ignored as the RFC says, only a start past the end is 416
+    '''
+    unit, _, spec = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None  # multipart ranges not supported, whole file is allowed by the RFC
+    first, sep, last = spec.strip().partition('-')
+    # digits only, int() would also take a sign (bytes=--5), spaces and underscores
+    if not sep or not spec.isascii() or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if first == '':
+        suffix = int(last)  # suffix: last n bytes
+        if suffix == 0 or size == 0:
+            return False
+        return max(size - suffix, 0), size - 1
+    start = int(first)
+    end = int(last) if last else None
+    if end is not None and end < start:
+        return None
+    if start >= size:
+        return False
+    return start, size - 1 if end is None else min(end, size - 1)
+
+def serve_static(root_dir, listen):
+    host, port = listen.rsplit(':', 1)
+    handler = functools.partial(StaticHandler, directory=root_dir)
+    httpd = http.server.ThreadingHTTPServer((host, int(port)), handler)
+    httpd.daemon_threads = True
+    print(f"Serving {root_dir} at http://{listen}/")
+    httpd.serve_forever()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-T', '--root-dir', required=True, help='DeoVR root dir')
     parser.add_argument('-l', '--listen',
                         default='localhost:8000',
                         help='Server listen address')
+    parser.add_argument('-s', '--static', help='also serve the root dir (videos, thumbnails, json) at this address, host:port, so no nginx is needed')
+    parser.add_argument('--static-only', action='store_true', help='only run the static server, no web UI')
+    parser.add_argument('--debug', action='store_true', help='flask debug mode, auto reload')
     args = parser.parse_args()
     # global var
     root_dir = args.root_dir
     
     # print(f"os.getcwd(): {os.getcwd()}")
+    if args.static_only:
+        serve_static(root_dir, args.static or args.listen)
+        exit(0)
+    if args.static:
+        threading.Thread(target=serve_static, args=(root_dir, args.static), daemon=True).start()
     host, port = args.listen.rsplit(':', 1)
-    app.run(host=host, port=int(port), debug=True)
+    app.run(host=host, port=int(port), debug=args.debug, use_reloader=args.debug and not args.static, threaded=True)
@@ -0,0 +1,64 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_utils
+import library
+from db_utils import add_hls_encoding, scan_playlist, watch_playlists
+from library import open_library
+
+@pytest.fixture(autouse=True)
+def fresh_libraries():
+    library.libraries.clear()
+    yield
+    for lib in library.libraries.values():
+        lib.conn.close()
+    library.libraries.clear()
+
+def test_scan_skips_failing_file(tmp_path, monkeypatch):
+    root_dir = str(tmp_path)
+    (tmp_path / 'A').mkdir()
+    (tmp_path / 'A' / 'broken - h264 1080p.mp4').write_bytes(b'half copied')
+    open_library(root_dir).add_playlist('A')
+
+    calls = []
+    def fail(*args):
+        calls.append(args[2])
+        raise RuntimeError("ffprobe error")
+    monkeypatch.setattr(db_utils, 'scan_video_job', fail)
+    res = scan_playlist(root_dir, 'http://s', 'A', incremental=True)
+    assert res['status']
+    # not in the snapshot, the next round tries again
+    assert open_library(root_dir).get_snapshot('A') == {}
+    scan_playlist(root_dir, 'http://s', 'A', incremental=True)
+    assert len(calls) == 2
+
+def test_watch_survives_scan_errors(tmp_path, monkeypatch):
+    calls = []
+    def scan(root_dir, server, playlist, **kwargs):
+        calls.append(playlist)
+        if playlist == 'A' and calls.count('A') == 1:
+            raise OSError("unreadable")
+        return {"status": True, "msg": "no change", "deferred": 0}
+    def sleep(seconds):
+        if len(calls) >= 4:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(db_utils, 'scan_playlist', scan)
+    monkeypatch.setattr(db_utils, 'inotify_simple', None)
+    monkeypatch.setattr(db_utils.time, 'sleep', sleep)
+    with pytest.raises(KeyboardInterrupt):
+        watch_playlists(str(tmp_path), 'http://s', ['A', 'B'])
+    assert calls == ['A', 'B', 'A', 'B']
+
+def test_hls_failure_keeps_encodings(tmp_path, monkeypatch):
+    def probe(path):
+        raise FileNotFoundError("ffprobe")
+    monkeypatch.setattr(db_utils.ffmpeg, 'probe', probe)
+    encodings = [{'name': 'h264', 'videoSources': [{'resolution': 1080, 'url': 'http://s/A/title - h264 1080p.mp4'}]}]
+    meta_data = {'width': 1920, 'height': 1080, 'encoding': 'h264'}
+    assert not add_hls_encoding(str(tmp_path), 'http://s', 'A', encodings, str(tmp_path / 'A' / 'title - h264 1080p.mp4'), meta_data, heights=[720])
+    assert [encoding['name'] for encoding in encodings] == ['h264']
+    assert not os.path.exists(tmp_path / 'A' / 'metadata' / 'hls')
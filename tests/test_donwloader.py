@@ -0,0 +1,232 @@
+import asyncio
+import errno
+import http.server
+import os
+import sys
+import threading
+import time
+import zlib
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import async_downloader
+import donwloader
+from donwloader import ConcurrencyController, RangeScheduler, allocate_file, make_session, open_output_fd, prepare_scheduler, read_recover_file, verify_download, write_at
+
+HEAD_SIZE = 64
+CHUNK_SIZE = 1024**2
+
+def run_scheduler(scheduler, data):
+    '''what the worker threads do: take ranges until none left, write them'''
+    while True:
+        task = scheduler.next_range(0)
+        if task is None:
+            break
+        range_id, start, end = task
+        piece = data[start:end + 1]
+        write_at(scheduler.fd, piece, start)
+        scheduler.update(range_id, end + 1, zlib.crc32(piece))
+        scheduler.finish(range_id, 0, len(piece), 1)
+
+def start_download(tmp_path, data):
+    output_file = str(tmp_path / 'video.mp4')
+    recover_file = str(tmp_path / 'video.recover.json')
+    recover_data = read_recover_file(recover_file)
+    fd = open_output_fd(output_file, truncate=recover_data is None)
+    scheduler = prepare_scheduler(fd, recover_file, recover_data, len(data), HEAD_SIZE, CHUNK_SIZE)
+    os.ftruncate(fd, len(data))
+    scheduler.write_head(data[:HEAD_SIZE])
+    return scheduler
+
+def test_verify_failure_then_complete(tmp_path):
+    data = os.urandom(3 * CHUNK_SIZE + 123)
+
+    # first run: a segment is lost, verify fails and resets the journal
+    scheduler = start_download(tmp_path, data)
+    run_scheduler(scheduler, data)
+    scheduler.segments.pop()
+    assert not verify_download(scheduler, {})
+    scheduler.save()
+    os.close(scheduler.fd)
+
+    # second run downloads everything again and must verify
+    scheduler = start_download(tmp_path, data)
+    assert scheduler.pending == [[HEAD_SIZE, len(data) - 1]]
+    run_scheduler(scheduler, data)
+    checksum = {}
+    assert verify_download(scheduler, checksum)
+    assert checksum['crc32'] == f"{zlib.crc32(data):08x}"
+    os.close(scheduler.fd)
+    with open(tmp_path / 'video.mp4', 'rb') as f:
+        assert f.read() == data
+
+class FlakyHandler(http.server.BaseHTTPRequestHandler):
+    '''/missing is 404, /busy answers 429 once then the body, /short closes before the end'''
+    body = b'video' * 1000
+    busy = 0
+
+    def do_GET(self):
+        if self.path == '/missing' or (self.path == '/busy' and FlakyHandler.busy == 0):
+            FlakyHandler.busy += self.path == '/busy'
+            error_page = b'<html>error</html>'
+            self.send_response(404 if self.path == '/missing' else 429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', str(len(error_page)))
+            self.end_headers()
+            self.wfile.write(error_page)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body[:100] if self.path == '/short' else self.body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def flaky_server():
+    FlakyHandler.busy = 0
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FlakyHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+@pytest.mark.parametrize('engine', [donwloader, async_downloader])
+def test_single_stream_checks_status(tmp_path, flaky_server, engine):
+    session = make_session()
+    output_file = str(tmp_path / 'video.mp4')
+    checksum = {}
+    assert not engine.download_file(session, f"{flaky_server}/missing", output_file, repeat=2, checksum=checksum)
+    assert not os.path.exists(output_file) and not checksum
+
+    # truncated on every try: nothing at the final name for the next run to skip
+    assert not engine.download_file(session, f"{flaky_server}/short", output_file, repeat=2, checksum=checksum)
+    assert not os.path.exists(output_file) and not os.path.exists(output_file + '.part')
+
+    assert engine.download_file(session, f"{flaky_server}/busy", output_file, repeat=2, checksum=checksum)
+    with open(output_file, 'rb') as f:
+        assert f.read() == FlakyHandler.body
+    assert checksum['crc32'] == f"{zlib.crc32(FlakyHandler.body):08x}"
+    assert not os.path.exists(output_file + '.part')
+
+@pytest.mark.parametrize('engine', [donwloader, async_downloader])
+def test_single_stream_stop_leaves_no_file(tmp_path, flaky_server, engine):
+    output_file = str(tmp_path / 'thumbnail.jpg')
+    donwloader.stop_event.set()  # Ctrl-C in playlist mode
+    try:
+        assert not engine.download_file(make_session(), f"{flaky_server}/busy", output_file, repeat=2)
+    finally:
+        donwloader.stop_event.clear()
+    assert os.listdir(tmp_path) == []
+
+def test_controller_steps_back_on_plateau():
+    controller = ConcurrencyController('host', initial=4, max_limit=16, state_file=None)
+    written = 0
+    limits = []
+    for speed in [100, 200, 300, 300, 300, 300]:  # MB/s, flat from 5 connections on
+        written += speed * 1024**2
+        controller.last_time = time.time() - 1
+        controller.sample(written)
+        limits.append(controller.limit)
+    assert limits == [5, 6, 7, 6, 6, 6]
+
+    controller.report_error()
+    written += 300 * 1024**2
+    controller.last_time = time.time() - 1
+    controller.sample(written)
+    assert controller.limit == 3
+
+def test_tail_split_ignores_parked_threads(tmp_path):
+    chunk_size = 8 * 1024**2
+    fd = open_output_fd(str(tmp_path / 'video.mp4'))
+    scheduler = RangeScheduler('', fd, 16 * 1024**2, chunk_size)
+    scheduler.add_region(0, 16 * 1024**2 - 1)
+    for tid in range(16):  # auto threads: all registered, only two allowed by the controller
+        scheduler.range_size.setdefault(tid, chunk_size)
+    _, start, end = scheduler.next_range(0)
+    assert end - start + 1 == chunk_size
+    _, start, end = scheduler.next_range(1)  # the rest is spread over the two working threads
+    assert end - start + 1 == chunk_size // 2
+    os.close(fd)
+
+@pytest.mark.parametrize('engine', [donwloader, async_downloader])
+def test_chunks_leave_no_recover_file(tmp_path, monkeypatch, engine):
+    from server import StaticHandler
+    data = os.urandom(4 * 1024**2 + 99)
+    (tmp_path / 'remote.mp4').write_bytes(data)
+    handler = type('QuietHandler', (StaticHandler,), {'log_message': lambda self, *args: None})
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: handler(*args, directory=str(tmp_path)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # ~2s download, the journal save started after 1s is still running when it ends
+    save = RangeScheduler.save
+    def slow_save(self):
+        self.fsync = False  # fd may be closed by then, the journal is still written
+        time.sleep(1.5)
+        save(self)
+    monkeypatch.setattr(RangeScheduler, 'save', slow_save)
+    donwloader.set_rate_limit(2 * 1024**2)
+
+    output_file = str(tmp_path / 'video.mp4')
+    recover_file = str(tmp_path / 'video.recover.json')
+    checksum = {}
+    try:
+        assert engine.download_file_in_chunks(make_session(), f"http://127.0.0.1:{httpd.server_address[1]}/remote.mp4", chunk_size=1024**2,
+                                              output_file=output_file, recover_file=recover_file, max_threads=2, journal_interval=0, state_file=None, checksum=checksum)
+    finally:
+        httpd.shutdown()
+        donwloader.set_rate_limit(0)
+    time.sleep(2)
+    assert not os.path.exists(recover_file)
+    assert checksum['crc32'] == f"{zlib.crc32(data):08x}"
+    with open(output_file, 'rb') as f:
+        assert f.read() == data
+
+def test_allocate_without_fallocate_support(tmp_path, monkeypatch):
+    output_file = str(tmp_path / 'video.mp4')
+    fd = open_output_fd(output_file)
+    assert allocate_file(fd, output_file, 3 * CHUNK_SIZE)
+    assert os.fstat(fd).st_size == 3 * CHUNK_SIZE
+
+    # filesystem without fallocate: sparse file, never emulated by writing every block
+    def unsupported(fd, length):
+        raise OSError(errno.EOPNOTSUPP, os.strerror(errno.EOPNOTSUPP))
+    monkeypatch.setattr(donwloader, 'fallocate', unsupported)
+    assert allocate_file(fd, output_file, 5 * CHUNK_SIZE)
+    assert os.fstat(fd).st_size == 5 * CHUNK_SIZE
+    os.close(fd)
+
+def test_async_file_io_off_the_loop(tmp_path, monkeypatch):
+    from server import StaticHandler
+    data = os.urandom(2 * 1024**2)
+    (tmp_path / 'remote.mp4').write_bytes(data)
+    handler = type('QuietHandler', (StaticHandler,), {'log_message': lambda self, *args: None})
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), lambda *args: handler(*args, directory=str(tmp_path)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    # slow disk: every write and the verify block for a while
+    def slow(fn):
+        def wrapper(*args):
+            time.sleep(0.3)
+            return fn(*args)
+        return wrapper
+    monkeypatch.setattr(async_downloader, 'write_at', slow(write_at))
+    monkeypatch.setattr(async_downloader, 'verify_download', slow(verify_download))
+
+    # another transfer on the shared loop keeps running meanwhile
+    ticks = []
+    async def ticker():
+        while True:
+            ticks.append(time.time())
+            await asyncio.sleep(0.02)
+    tick_task = asyncio.run_coroutine_threadsafe(ticker(), async_downloader.get_loop())
+    try:
+        assert async_downloader.download_file_in_chunks(make_session(), f"http://127.0.0.1:{httpd.server_address[1]}/remote.mp4", chunk_size=1024**2,
+                                                        output_file=str(tmp_path / 'video.mp4'), recover_file=str(tmp_path / 'video.recover.json'),
+                                                        max_threads=2, journal_interval=0, state_file=None)
+    finally:
+        tick_task.cancel()
+        httpd.shutdown()
+    assert max(b - a for a, b in zip(ticks, ticks[1:])) < 0.2
@@ -0,0 +1,177 @@
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import library
+from db_utils import change_server, plan_move_title, read_video_json, write_db_json, write_video_json
+from library import BATCH_JOURNAL, BATCH_LOCK, Library, open_library
+
+def make_video_json(server, playlist, title):
+    return {
+        'title': title,
+        'videoLength': 60,
+        'video_url': f"{server}/{playlist}/metadata/json/{title}.json",
+        'thumbnailUrl': f"{server}/{playlist}/metadata/thumbnail/{title}_thumbnail.jpg",
+        'encodings': [{'name': 'h264', 'videoSources': [{'resolution': 1080, 'url': f"{server}/{playlist}/{title} - h264 1080p.mp4"}]}],
+    }
+
+@pytest.fixture(autouse=True)
+def fresh_libraries():
+    library.libraries.clear()
+    yield
+    for lib in library.libraries.values():
+        lib.conn.close()
+    library.libraries.clear()
+
+def make_root(root_dir, playlists):
+    '''{playlist: [title]} with video json and a video file per title'''
+    os.makedirs(root_dir, exist_ok=True)
+    lib = open_library(root_dir)
+    with lib.batch():
+        for playlist, titles in playlists.items():
+            lib.add_playlist(playlist)
+            os.makedirs(os.path.join(root_dir, playlist, 'metadata', 'json'), exist_ok=True)
+            for title in titles:
+                video_json = make_video_json('http://s', playlist, title)
+                write_video_json(root_dir, playlist, title, video_json)
+                open(os.path.join(root_dir, playlist, f"{title} - h264 1080p.mp4"), 'w').close()
+                lib.add_title(playlist, video_json)
+    return lib
+
+def test_roll_forward_from_another_cwd(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    lib = make_root('lib', {'A': ['title1', 'title2'], 'B': []})
+
+    # move planned with a relative root dir, interrupted after the journal was written
+    ops = plan_move_title('lib', 'A', 'B', 'title2')
+    monkeypatch.setattr(Library, 'run_ops', lambda self, ops: (_ for _ in ()).throw(KeyboardInterrupt()))
+    with pytest.raises(KeyboardInterrupt):
+        lib.apply(ops)
+    monkeypatch.undo()
+    assert os.path.exists(tmp_path / 'lib' / BATCH_JOURNAL)
+
+    # next tool runs from somewhere else
+    other = tmp_path / 'other'
+    other.mkdir()
+    monkeypatch.chdir(other)
+    lib.conn.close()
+    library.libraries.clear()
+    lib = open_library(str(tmp_path / 'lib'))
+    assert not os.path.exists(tmp_path / 'lib' / BATCH_JOURNAL)
+    assert os.path.exists(tmp_path / 'lib' / 'B' / 'title2 - h264 1080p.mp4')
+    assert os.path.exists(tmp_path / 'lib' / 'B' / 'metadata' / 'json' / 'title2.json')
+    assert list(lib.get_titles('A')) == ['title1'] and list(lib.get_titles('B')) == ['title2']
+
+def test_running_batch_is_not_rolled_forward(tmp_path, monkeypatch):
+    root_dir = str(tmp_path)
+    lib = make_root(root_dir, {'A': ['title1'], 'B': []})
+    monkeypatch.setattr(Library, 'run_ops', lambda self, ops: (_ for _ in ()).throw(KeyboardInterrupt()))
+    with pytest.raises(KeyboardInterrupt):
+        lib.apply(plan_move_title(root_dir, 'A', 'B', 'title1'))
+    monkeypatch.undo()
+    extra_file = tmp_path / 'A' / 'extra.txt'
+    extra_file.write_text('')
+
+    with open(tmp_path / BATCH_LOCK, 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)  # another process is still running the journaled batch
+        lib.conn.close()
+        library.libraries.clear()
+        lib = open_library(root_dir)
+        assert os.path.exists(tmp_path / BATCH_JOURNAL)
+        assert os.path.exists(tmp_path / 'A' / 'title1 - h264 1080p.mp4')
+
+        # a batch of this process waits for the lock
+        other = threading.Thread(target=lib.apply, args=([{'op': 'delete', 'path': str(extra_file)}],))
+        other.start()
+        time.sleep(0.2)
+        assert other.is_alive() and extra_file.exists()
+    # lock released without finishing (the holder died): its journal runs first, then the waiting batch
+    other.join(5)
+    assert not other.is_alive()
+    assert not os.path.exists(tmp_path / BATCH_JOURNAL) and not extra_file.exists()
+    assert os.path.exists(tmp_path / 'B' / 'title1 - h264 1080p.mp4')
+    assert list(lib.get_titles('A')) == [] and list(lib.get_titles('B')) == ['title1']
+
+def check_deeplink(deeplink, server='http://s'):
+    '''DeoVR multiple videos deeplink: scenes with a name and a list of videos, absolute urls'''
+    assert isinstance(deeplink['scenes'], list) and deeplink['scenes']
+    for scene in deeplink['scenes']:
+        assert isinstance(scene['name'], str)
+        assert isinstance(scene['list'], list)
+        for video in scene['list']:
+            assert isinstance(video['title'], str)
+            assert video['video_url'].startswith(f"{server}/")
+            assert video['thumbnail_url'].startswith(f"{server}/")
+
+def test_split_deeplink_schema(tmp_path):
+    root_dir = str(tmp_path)
+    lib = make_root(root_dir, {'A': [f"title{i}" for i in range(5)], 'B C': ['title5']})
+    lib.set_deeplink_page_size(2, 'http://s/')
+
+    with open(tmp_path / 'deeplink' / 'index.json') as f:
+        index = json.load(f)
+    check_deeplink(index)
+    scenes = {scene['name']: scene for scene in index['scenes']}
+    assert [v['title'] for v in scenes['A']['list']] == ['title0', 'title1']
+    assert scenes['A']['total'] == 5
+    assert scenes['A']['pages'] == [f"http://s/deeplink/A/{page}.json" for page in [1, 2, 3]]
+    assert scenes['B C']['pages'] == ['http://s/deeplink/B%20C/1.json']
+
+    titles = []
+    for url in scenes['A']['pages']:
+        with open(tmp_path / url[len('http://s/'):]) as f:
+            page = json.load(f)
+        check_deeplink(page)
+        assert len(page['scenes']) == 1
+        titles += [v['title'] for v in page['scenes'][0]['list']]
+    assert titles == [f"title{i}" for i in range(5)]
+
+    # only the changed playlist is written again, removed pages are deleted
+    with lib.batch():
+        lib.del_title('A', 'title4')
+    assert not os.path.exists(tmp_path / 'deeplink' / 'A' / '3.json')
+    with open(tmp_path / 'deeplink' / 'index.json') as f:
+        assert json.load(f)['scenes'][0]['pages'] == ['http://s/deeplink/A/1.json', 'http://s/deeplink/A/2.json']
+
+def read_split_deeplink(root_dir):
+    with open(os.path.join(root_dir, 'deeplink', 'index.json')) as f:
+        index = json.load(f)
+    pages = {}
+    for scene in index['scenes']:
+        for url in scene['pages']:
+            with open(os.path.join(root_dir, 'deeplink', *url.split('/deeplink/', 1)[1].split('/'))) as f:
+                pages[url] = json.load(f)
+    return index, pages
+
+def test_change_server_rewrites_split_deeplink(tmp_path):
+    root_dir = str(tmp_path)
+    lib = make_root(root_dir, {'A': [f"title{i}" for i in range(3)]})
+    lib.set_deeplink_page_size(2, 'http://s/')
+
+    change_server(root_dir, 'http://s', 'http://t:8000/')
+    index, pages = read_split_deeplink(root_dir)
+    check_deeplink(index, 'http://t:8000')
+    assert index['scenes'][0]['pages'] == ['http://t:8000/deeplink/A/1.json', 'http://t:8000/deeplink/A/2.json']
+    for page in pages.values():
+        check_deeplink(page, 'http://t:8000')
+    with open(tmp_path / 'top.json') as f:
+        check_deeplink(json.load(f), 'http://t:8000')
+    assert read_video_json(root_dir, 'A', 'title0')['video_url'].startswith('http://t:8000/')
+
+def test_full_replace_rewrites_split_deeplink(tmp_path):
+    root_dir = str(tmp_path)
+    lib = make_root(root_dir, {'A': ['title0'], 'B': ['title1']})
+    lib.set_deeplink_page_size(2, 'http://s/')
+
+    db_json = lib.to_db_json()
+    db_json['scenes'][1]['list'].append(make_video_json('http://s', 'B', 'title2'))
+    write_db_json(root_dir, db_json)
+    _, pages = read_split_deeplink(root_dir)
+    assert [v['title'] for v in pages['http://s/deeplink/B/1.json']['scenes'][0]['list']] == ['title1', 'title2']
@@ -0,0 +1,93 @@
+import functools
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import StaticHandler, parse_range
+
+DATA = bytes(range(256)) * 40
+
+class QuietHandler(StaticHandler):
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(scope='module')
+def static_server(tmp_path_factory):
+    root_dir = tmp_path_factory.mktemp('root')
+    (root_dir / 'P').mkdir()
+    (root_dir / 'P' / 'video.mp4').write_bytes(DATA)
+    (root_dir / 'deovr').write_text('{"scenes": []}')
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(root_dir)))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+def get(url, **headers):
+    return requests.get(url, headers=headers, timeout=5)
+
+def test_whole_file(static_server):
+    r = get(f"{static_server}/P/video.mp4")
+    assert r.status_code == 200 and r.content == DATA
+    assert r.headers['Content-Type'] == 'video/mp4'
+    assert r.headers['Accept-Ranges'] == 'bytes'
+    assert 'Content-Range' not in r.headers
+
+@pytest.mark.parametrize('spec, start, end', [
+    ('bytes=100-199', 100, 199),
+    ('bytes=0-', 0, len(DATA) - 1),       # first probe of a player, must be 206
+    ('bytes=-10', len(DATA) - 10, len(DATA) - 1),
+    ('bytes=10000-99999', 10000, len(DATA) - 1),
+])
+def test_range(static_server, spec, start, end):
+    r = get(f"{static_server}/P/video.mp4", Range=spec)
+    assert r.status_code == 206
+    assert r.headers['Content-Range'] == f"bytes {start}-{end}/{len(DATA)}"
+    assert r.content == DATA[start:end + 1]
+
+@pytest.mark.parametrize('spec', ['bytes=100-50', 'bytes=abc', 'items=0-10', 'bytes=0-10,20-30',
+                                  'bytes=--5', 'bytes=-+5', 'bytes=+5-10', 'bytes=5--10', 'bytes=1_0-20', 'bytes=0x10-20',
+                                  'bytes=5', 'bytes=-'])
+def test_range_ignored(static_server, spec):
+    r = get(f"{static_server}/P/video.mp4", Range=spec)
+    assert r.status_code == 200 and r.content == DATA
+
+@pytest.mark.parametrize('spec, expected', [
+    ('bytes=--5', None), ('bytes=-+5', None), ('bytes= 5 - 10', None), ('bytes=5-1 0', None), ('bytes=', None), ('bytes=٣-9', None),
+    ('bytes=0-', (0, 99)), ('bytes=-5', (95, 99)), ('bytes=-500', (0, 99)), ('bytes=90-500', (90, 99)),
+    ('bytes=100-', False), ('bytes=-0', False),
+])
+def test_parse_range(spec, expected):
+    assert parse_range(spec, 100) == expected
+
+@pytest.mark.parametrize('spec', [f'bytes={len(DATA)}-', 'bytes=-0'])
+def test_range_not_satisfiable(static_server, spec):
+    r = get(f"{static_server}/P/video.mp4", Range=spec)
+    assert r.status_code == 416
+    assert r.headers['Content-Range'] == f"bytes */{len(DATA)}"
+
+def test_not_modified(static_server):
+    r = get(f"{static_server}/P/video.mp4")
+    assert get(f"{static_server}/P/video.mp4", **{'If-None-Match': r.headers['ETag']}).status_code == 304
+    assert get(f"{static_server}/P/video.mp4", **{'If-Modified-Since': r.headers['Last-Modified']}).status_code == 304
+    assert get(f"{static_server}/P/video.mp4", **{'If-None-Match': '"other"'}).status_code == 200
+
+def test_if_range(static_server):
+    etag = get(f"{static_server}/P/video.mp4").headers['ETag']
+    r = get(f"{static_server}/P/video.mp4", Range='bytes=0-9', **{'If-Range': etag})
+    assert r.status_code == 206 and r.content == DATA[:10]
+    # file changed since: the whole file instead of a range of the new one
+    r = get(f"{static_server}/P/video.mp4", Range='bytes=0-9', **{'If-Range': '"old"'})
+    assert r.status_code == 200 and r.content == DATA
+
+def test_deovr_and_dirs(static_server):
+    r = get(f"{static_server}/deovr")
+    assert r.status_code == 200 and r.headers['Content-Type'] == 'application/json'
+    assert r.headers['Cache-Control'] == 'no-cache'
+    assert get(f"{static_server}/P/").status_code == 404
+    assert get(f"{static_server}/P/missing.mp4").status_code == 404
@@ -1,8 +1,8 @@
 import argparse
 import os
-import shutil
 
 from db_utils import *
+from library import DEEPLINK_PAGE_SIZE
 
 parser = argparse.ArgumentParser(description='DeoVR database json manipulate tool')
 parser.add_argument('-T', '--root-dir', required=True, help='DeoVR root dir')
@@ -48,89 +48,115 @@ parser_scan.add_argument('--screenType', default="flat", help='flat, dome(180),
 parser_scan.add_argument('--stereoMode', default="sbs", help='sbs, tb')
 parser_scan.add_argument('-s', '--thumbnail-start-time', type=int, default=-1, help='specific thumbnail shot time. default shot at 1/3 duration')
 parser_scan.add_argument('-F', '--force-thumbnail', type=int, default=0, help='bitmask, force regenerate video seek|video preview|thumbnail')
+parser_scan.add_argument('-j', '--jobs', type=int, default=1, help='videos probed and thumbnailed in parallel (processes)')
+parser_scan.add_argument('--timeline-mode', default='seek', choices=TIMELINE_MODES, help='timeline frames: seek to nearest keyframes (fast), decode keyframes, or decode all frames (exact)')
+parser_scan.add_argument('--timeline-quality', type=int, default=TIMELINE_QUALITY, help='jpeg quality of the timeline preview image')
+parser_scan.add_argument('-i', '--incremental', action='store_true', help='only scan video files added, removed or changed since the last scan')
 
-args = parser.parse_args()
+# deeplink
+parser_deeplink = subparsers.add_parser("deeplink", help="also write a split deeplink: deeplink/index.json with the first page of each playlist, and compact per-page deeplinks")
+parser_deeplink.add_argument('-S', '--server', default="http://localhost:8000", help='HTTP server address hosting the root dir')
+parser_deeplink.add_argument('--page-size', type=int, default=DEEPLINK_PAGE_SIZE, help='titles per page, 0 to stop writing the split deeplink')
 
-root_dir = args.root_dir
-if args.command == "list":
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    playlists = list(scene_index.keys())
-    if args.playlist:
-        playlists = [args.playlist]
-    for playlist in playlists:
-        print(f"{playlist}: ")
-        title_index = get_title_index(scene_index[playlist])
-        if args.all:
-            for title, video in title_index.items():
-                print(f"\t{title}")
-        elif args.multi_format:
-            for title, video in title_index.items():
-                video_json = read_video_json(root_dir, playlist, title)
-                formats = get_video_formats(video_json)
-                if len(formats) > 1:
-                    print(f"\t{title}: {formats}")
+# watch
+parser_watch = subparsers.add_parser("watch", help="keep running, incremental scan when video files change")
+parser_watch.add_argument('-S', '--server', default="http://localhost:8000", help='Old HTTP server address')
+parser_watch.add_argument('-P', '--playlist', action='append', help='watch specific playlist, can be repeated, default all playlists')
+parser_watch.add_argument('--screenType', default="flat", help='flat, dome(180), sphere(360)')
+parser_watch.add_argument('--stereoMode', default="sbs", help='sbs, tb')
+parser_watch.add_argument('-j', '--jobs', type=int, default=1, help='videos probed and thumbnailed in parallel (processes)')
+parser_watch.add_argument('--timeline-mode', default='seek', choices=TIMELINE_MODES, help='see scan')
+parser_watch.add_argument('--timeline-quality', type=int, default=TIMELINE_QUALITY, help='see scan')
+parser_watch.add_argument('--interval', type=int, default=10, help='poll interval in seconds, when inotify_simple is not installed')
+parser_watch.add_argument('--settle', type=int, default=10, help='seconds a video file must be unchanged before it is scanned')
+
+# the scan workers (-j) import this module again on spawn platforms, parse args only when run
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    root_dir = args.root_dir
+    library = open_library(root_dir)
+    if args.command == "list":
+        playlists = library.get_playlists()
+        if args.playlist:
+            playlists = [args.playlist]
+        for playlist in playlists:
+            print(f"{playlist}: ")
+            title_index = library.get_titles(playlist)
+            if args.all:
+                for title, video in title_index.items():
+                    print(f"\t{title}")
+            elif args.multi_format:
+                for title, video in title_index.items():
+                    video_json = read_video_json(root_dir, playlist, title)
+                    formats = get_video_formats(video_json)
+                    if len(formats) > 1:
+                        print(f"\t{title}: {formats}")
+            else:
+                print(f"\t{len(title_index)} videos")
+    elif args.command == "change":
+        res = change_server(root_dir, args.server, args.replace_server)
+        print(res)
+    elif args.command == "move":
+        title_list = []
+        if args.title:
+            title_list = [args.title]
         else:
-            print(f"\t{len(title_index)} videos")
-elif args.command == "change":
-    res = change_server(root_dir, args.server, args.replace_server)
-    print(res)
-elif args.command == "move":
-    title_list = []
-    if args.title:
-        title_list = [args.title]
-    else:
-        db_json = read_db_json(root_dir)
-        scene_index = get_scene_index(db_json)
-        if args.src not in scene_index or args.dst not in scene_index:
-            print(f"Playlist {args.src} or {args.dst} not found")
-            exit(1)
-        title_index = get_title_index(scene_index[args.src])
-        title_list = list(title_index.keys())
+            if not library.has_playlist(args.src) or not library.has_playlist(args.dst):
+                print(f"Playlist {args.src} or {args.dst} not found")
+                exit(1)
+            title_list = list(library.get_titles(args.src))
     
-    for title in title_list:
-        print(f"Moving {title}")
-        move_title_from_to(root_dir, args.src, args.dst, title)
+        # plan everything first, then run it as one journaled batch
+        listings = {}  # src dirs listed once for all titles
+        ops = []
+        for title in title_list:
+            if not check_move_title(library, args.src, args.dst, title)['status']:
+                continue
+            print(f"Moving {title}")
+            ops += plan_move_title(root_dir, args.src, args.dst, title, listings)
     
-    # remove playlist in db
-    db_json = read_db_json(root_dir)
-    db_del_playlist(db_json, args.src)
-    write_db_json(root_dir, db_json)
+        if not args.title:
+            # remove playlist in db and its dir
+            # input(f"Remove {args.src} playlist? Press Enter to continue...")
+            print(f"Remove {args.src} playlist")
+            ops.append({'op': 'del_playlist', 'playlist': args.src})
+            ops.append({'op': 'delete', 'path': os.path.join(root_dir, args.src)})
+        library.apply(ops)
     
-    # remove playlist dir
-    # input(f"Remove {args.src} playlist? Press Enter to continue...")
-    print(f"Remove {args.src} playlist")
-    shutil.rmtree(os.path.join(root_dir, args.src))
-    
-elif args.command == "dupdel":
-    db_json = read_db_json(root_dir)
-    scene_index = get_scene_index(db_json)
-    title_index_src = get_title_index(scene_index[args.src])
-    title_index_ref = get_title_index(scene_index[args.ref])
-    for title in title_index_src:
-        if title in title_index_ref:
-            print(f"Delete {title}", end=" ")
-            delete_title_files(root_dir, args.src, title)
-            succ = db_del_title(db_json, args.src, title)
-            print("Succ" if succ else "Failed")
-            write_db_json(root_dir, db_json)
+    elif args.command == "dupdel":
+        title_index_src = library.get_titles(args.src)
+        title_index_ref = library.get_titles(args.ref)
+        listings = {}
+        ops = []
+        for title in title_index_src:
+            if title in title_index_ref:
+                print(f"Delete {title}")
+                ops += plan_delete_title(root_dir, args.src, title, listings)
+        library.apply(ops)
 
-elif args.command == "rename":
-    rename_playlist(root_dir, args.src, args.dst)
-elif args.command == "check":
-    if args.playlist:
-        check_playlist(root_dir, args.playlist)
-    else:
-        scene_index = get_scene_index(read_db_json(root_dir))
-        for playlist in scene_index:
-            check_playlist(root_dir, playlist)
-elif args.command == "scan":
-    if args.playlist:
-        scan_playlist(root_dir, args.server, args.playlist, title=args.title, screenType=args.screenType, stereoMode=args.stereoMode, thumbnail_start_time=args.thumbnail_start_time, force_thumbnail=args.force_thumbnail)
+    elif args.command == "rename":
+        rename_playlist(root_dir, args.src, args.dst)
+    elif args.command == "check":
+        playlists = [args.playlist] if args.playlist else library.get_playlists()
+        ops = []
+        for playlist in playlists:
+            ops += plan_check_playlist(root_dir, playlist)
+        library.apply(ops)
+    elif args.command == "scan":
+        if args.playlist:
+            scan_playlist(root_dir, args.server, args.playlist, title=args.title, screenType=args.screenType, stereoMode=args.stereoMode, thumbnail_start_time=args.thumbnail_start_time, force_thumbnail=args.force_thumbnail, jobs=args.jobs, timeline_mode=args.timeline_mode, timeline_quality=args.timeline_quality, incremental=args.incremental)
+        else:
+            for playlist in library.get_playlists():
+                scan_playlist(root_dir, args.server, playlist, title=args.title, screenType=args.screenType, stereoMode=args.stereoMode, thumbnail_start_time=args.thumbnail_start_time, force_thumbnail=args.force_thumbnail, jobs=args.jobs, timeline_mode=args.timeline_mode, timeline_quality=args.timeline_quality, incremental=args.incremental)
+    elif args.command == "deeplink":
+        library.set_deeplink_page_size(args.page_size, args.server)
+    elif args.command == "watch":
+        playlists = args.playlist if args.playlist else library.get_playlists()
+        try:
+            watch_playlists(root_dir, args.server, playlists, interval=args.interval, settle=args.settle, screenType=args.screenType, stereoMode=args.stereoMode, jobs=args.jobs, timeline_mode=args.timeline_mode, timeline_quality=args.timeline_quality)
+        except KeyboardInterrupt:
+            print("Stop watching")
     else:
-        scene_index = get_scene_index(read_db_json(root_dir))
-        for playlist in scene_index:
-            scan_playlist(root_dir, args.server, playlist, title=args.title, screenType=args.screenType, stereoMode=args.stereoMode, thumbnail_start_time=args.thumbnail_start_time, force_thumbnail=args.force_thumbnail)
-else:
-    print("Not implemented")
-    exit(1)
+        print("Not implemented")
+        exit(1)